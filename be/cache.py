@@ -0,0 +1,133 @@
+import asyncio
+import hashlib
+import json
+import time
+from collections import OrderedDict
+
+
+def canonical_key(*parts) -> str:
+    """Stable string key for any JSON-like combination of request parts."""
+    return json.dumps(parts, sort_keys=True, default=str, separators=(",", ":"))
+
+
+def canonical_params(params, include: set[str] | None = None) -> dict:
+    """Normalize search params so equivalent requests share one cache entry.
+
+    `include` restricts the key to the params the response depends on.
+    """
+    values = params.model_dump(include=include)
+    # Surrounding whitespace is dropped by the analyzer anyway.
+    if values.get("q") and values["q"].strip():
+        values["q"] = values["q"].strip()
+    return values
+
+
+def strong_etag(*parts) -> str:
+    """Strong entity tag for a response fully determined by `parts`."""
+    digest = hashlib.sha256(canonical_key(*parts).encode()).hexdigest()
+    return f'"{digest[:32]}"'
+
+
+def etag_matches(if_none_match: str | None, etag: str) -> bool:
+    # If-None-Match uses the weak comparison, so W/ prefixes are ignored.
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    return any(tag.strip().removeprefix("W/") == etag
+               for tag in if_none_match.split(","))
+
+
+class ResultCache:
+    """In-process LRU cache bounded by the approximate size of its entries.
+
+    Entries expire after `ttl` seconds and can be dropped per index with
+    `invalidate` whenever the underlying index changes.
+    """
+
+    def __init__(self, max_bytes: int, ttl: float):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # key -> (index_name, expires_at, size, value)
+        self._entries = OrderedDict()
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        if entry[1] < time.monotonic():
+            self._remove(key)
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[3]
+
+    def set(self, key, index_name: str, value, size: int):
+        if size > self.max_bytes:
+            return
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = (index_name, time.monotonic() + self.ttl, size, value)
+        self.current_bytes += size
+        # Evict least recently used entries until we fit into the budget.
+        while self.current_bytes > self.max_bytes:
+            oldest_key = next(iter(self._entries))
+            self._remove(oldest_key)
+            self.evictions += 1
+
+    def invalidate(self, index_name: str | None = None):
+        if index_name is None:
+            self._entries.clear()
+            self.current_bytes = 0
+            return
+        for key in [k for k, v in self._entries.items() if v[0] == index_name]:
+            self._remove(key)
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self._entries),
+            "bytes": self.current_bytes,
+            "max_bytes": self.max_bytes,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+    def _remove(self, key):
+        _, _, size, _ = self._entries.pop(key)
+        self.current_bytes -= size
+
+
+class SingleFlight:
+    """Share one in-flight call between concurrent callers with the same key."""
+
+    def __init__(self):
+        self.calls = 0
+        self.collapsed = 0
+        self._in_flight = {}
+
+    async def run(self, key, function):
+        task = self._in_flight.get(key)
+        if task is None:
+            self.calls += 1
+            task = asyncio.ensure_future(function())
+            self._in_flight[key] = task
+            task.add_done_callback(lambda _: self._in_flight.pop(key, None))
+        else:
+            self.collapsed += 1
+        # Shielded so one disconnecting caller does not cancel the others.
+        return await asyncio.shield(task)
+
+    def stats(self) -> dict:
+        return {
+            "in_flight": len(self._in_flight),
+            "calls": self.calls,
+            "collapsed": self.collapsed,
+        }
@@ -0,0 +1,97 @@
+import csv
+import io
+import json
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+MEDIA_TYPES = {
+    "ndjson": "application/x-ndjson",
+    "csv": "text/csv",
+    "parquet": "application/vnd.apache.parquet",
+}
+
+
+def flatten(value):
+    # Nested values (custom fields, relationships) are exported as JSON strings.
+    if isinstance(value, (list, dict)):
+        return json.dumps(value)
+    return value
+
+
+async def to_ndjson(batches, columns):
+    async for batch in batches:
+        yield "".join(json.dumps(doc) + "\n" for doc in batch).encode()
+
+
+async def to_csv(batches, columns):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(columns)
+    async for batch in batches:
+        writer.writerows([flatten(doc.get(column)) for column in columns]
+                         for doc in batch)
+        yield buffer.getvalue().encode()
+        buffer.seek(0)
+        buffer.truncate()
+    # Header only for empty exports.
+    if buffer.tell():
+        yield buffer.getvalue().encode()
+
+
+class ChunkSink(io.RawIOBase):
+    """Write-only file collecting Parquet output until it is drained."""
+
+    def __init__(self):
+        super().__init__()
+        self.chunks = []
+        self.position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def drain(self):
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def parquet_schema(data_class, columns):
+    fields = []
+    for column in columns:
+        annotation = data_class.model_fields[column].annotation
+        if annotation in (float, float | None):
+            fields.append(pa.field(column, pa.float64()))
+        else:
+            fields.append(pa.field(column, pa.string()))
+    return pa.schema(fields)
+
+
+async def to_parquet(batches, columns, schema):
+    # Every batch becomes a row group, streamed as soon as it is written.
+    sink = ChunkSink()
+    writer = pq.ParquetWriter(pa.PythonFile(sink, mode="w"), schema)
+    async for batch in batches:
+        rows = [{column: flatten(doc.get(column)) for column in columns}
+                for doc in batch]
+        writer.write_table(pa.Table.from_pylist(rows, schema=schema))
+        yield sink.drain()
+    writer.close()
+    yield sink.drain()
+
+
+def export_stream(export_format, batches, data_class, field_names=None):
+    columns = field_names or list(data_class.model_fields)
+    if export_format == "csv":
+        return to_csv(batches, columns)
+    if export_format == "parquet":
+        return to_parquet(batches, columns, parquet_schema(data_class, columns))
+    return to_ndjson(batches, columns)
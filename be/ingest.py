@@ -0,0 +1,495 @@
+"""Index setup, loading and maintenance for registered data sources.
+
+    python ingest.py mapping data_portal
+    python ingest.py create data_portal
+    python ingest.py load data_portal samples.ndjson.gz [--create]
+    python ingest.py geo data_portal
+"""
+import argparse
+import asyncio
+import datetime
+import gzip
+import json
+import logging
+import os
+import sys
+import time
+import types
+from collections import Counter
+from typing import Union, get_args, get_origin
+
+import orjson
+from elasticsearch import AsyncElasticsearch
+from pydantic import BaseModel
+
+from models import data_sources
+from resilience import RETRYABLE_STATUSES, is_transient
+
+logger = logging.getLogger(__name__)
+
+# Bulk loading defaults, tunable per run with the load command options.
+INGEST_BATCH_SIZE = int(os.getenv("INGEST_BATCH_SIZE", 1000))
+INGEST_PARALLELISM = int(os.getenv("INGEST_PARALLELISM", 4))
+INGEST_MAX_RETRIES = int(os.getenv("INGEST_MAX_RETRIES", 5))
+INGEST_RETRY_BACKOFF = float(os.getenv("INGEST_RETRY_BACKOFF_SECONDS", 1))
+# Index settings while loading, restored afterwards.
+LOAD_SETTINGS = {"refresh_interval": "-1"}
+# Characters read at a time from JSON dumps.
+JSON_CHUNK_SIZE = 1 << 20
+
+GEO_PIPELINE_SCRIPT = """
+if (ctx[params.lat] != null && ctx[params.lon] != null) {
+    ctx[params.name] = ['lat': ctx[params.lat], 'lon': ctx[params.lon]];
+}
+"""
+
+# Elasticsearch types of field types, strings are filtered and aggregated on
+# as exact values. Search fields add an analyzed "text" sub-field.
+FIELD_TYPES = {
+    str: "keyword",
+    int: "long",
+    float: "double",
+    bool: "boolean",
+    datetime.datetime: "date",
+    datetime.date: "date",
+}
+
+# BioSamples characteristics stored as TREC fields, all other characteristics
+# become custom fields.
+BIOSAMPLES_FIELDS = {
+    "organism": "organism",
+    "depth": "depth",
+    "altitude": "altitude",
+    "geographic location (country and/or sea)": "location",
+}
+BIOSAMPLES_LAT = "geographic location (latitude)"
+BIOSAMPLES_LON = "geographic location (longitude)"
+BIOSAMPLES_DATE = "collection date"
+BIOSAMPLES_MISSING = "not provided"
+
+
+def es_client_from_env():
+    return AsyncElasticsearch(
+        [os.getenv("ES_URL")],
+        http_auth=(os.getenv("ES_USERNAME"), os.getenv("ES_PASSWORD")),
+        verify_certs=True,
+        request_timeout=float(os.getenv("ES_REQUEST_TIMEOUT_SECONDS", 60)),
+    )
+
+
+# Mappings.
+
+def type_mapping(type_):
+    # Optional and list fields are mapped like their items. Objects are not
+    # nested, so that free text search can reach their sub-fields.
+    origin = get_origin(type_)
+    if origin in (list, Union, types.UnionType):
+        args = [arg for arg in get_args(type_) if arg is not type(None)]
+        if len(args) != 1:
+            raise ValueError(f"Cannot map {type_}")
+        return type_mapping(args[0])
+    if isinstance(type_, type) and issubclass(type_, BaseModel):
+        return {"properties": {name: type_mapping(field.annotation)
+                               for name, field in type_.model_fields.items()}}
+    return {"type": FIELD_TYPES[type_]}
+
+
+def text_mapping(mapping):
+    # Keyword fields only match whole values, free text search matches the
+    # words of their "text" sub-field.
+    if "properties" in mapping:
+        return {"properties": {name: text_mapping(sub_mapping)
+                               for name, sub_mapping in mapping["properties"].items()}}
+    if mapping["type"] == "keyword":
+        return {**mapping, "fields": {"text": {"type": "text"}}}
+    return mapping
+
+
+def field_mapping(field):
+    mapping = type_mapping(field.type)
+    if field.search_boost is not None:
+        mapping = text_mapping(mapping)
+    if field.suggest:
+        # Completion sub-field read by the suggest endpoint.
+        mapping.setdefault("fields", {})["suggest"] = {"type": "completion"}
+    return mapping
+
+
+def index_mapping(data_source):
+    properties = {field.name: field_mapping(field) for field in data_source.fields}
+    if data_source.geo_point is not None:
+        properties[data_source.geo_point.name] = {"type": "geo_point"}
+    # Fields outside the data class are kept in _source without being indexed.
+    return {"dynamic": False, "properties": properties}
+
+
+def index_settings(data_source, shards, replicas):
+    settings = {"number_of_shards": shards, "number_of_replicas": replicas}
+    if data_source.geo_point is not None:
+        settings["default_pipeline"] = geo_pipeline_id(data_source)
+    return settings
+
+
+def geo_pipeline_id(data_source):
+    return f"{data_source.index_name}-geo"
+
+
+def geo_pipeline(geo_point):
+    # Derive the geo point from the stored coordinates on every write.
+    return {
+        "description": f"Index {geo_point.lat}/{geo_point.lon} as "
+                       f"{geo_point.name}",
+        "processors": [{
+            "script": {
+                "lang": "painless",
+                "source": GEO_PIPELINE_SCRIPT,
+                "params": {"name": geo_point.name, "lat": geo_point.lat,
+                           "lon": geo_point.lon},
+            }
+        }],
+    }
+
+
+async def create_index(es_client, data_source, shards, replicas):
+    # The geo pipeline has to exist before it becomes the default pipeline.
+    if data_source.geo_point is not None:
+        await es_client.ingest.put_pipeline(id=geo_pipeline_id(data_source),
+                                            **geo_pipeline(data_source.geo_point))
+    await es_client.indices.create(
+        index=data_source.index_name,
+        mappings=index_mapping(data_source),
+        settings=index_settings(data_source, shards, replicas),
+    )
+    print(f"Created {data_source.index_name}")
+
+
+async def setup_geo(es_client, data_source):
+    geo_point = data_source.geo_point
+    index_name = data_source.index_name
+    pipeline_id = geo_pipeline_id(data_source)
+    await es_client.indices.put_mapping(
+        index=index_name, properties={geo_point.name: {"type": "geo_point"}})
+    await es_client.ingest.put_pipeline(id=pipeline_id,
+                                        **geo_pipeline(geo_point))
+    await es_client.indices.put_settings(
+        index=index_name, settings={"index.default_pipeline": pipeline_id})
+    # Backfill documents indexed before the pipeline existed.
+    response = await es_client.update_by_query(
+        index=index_name,
+        pipeline=pipeline_id,
+        query={"bool": {
+            "filter": [{"exists": {"field": geo_point.lat}},
+                       {"exists": {"field": geo_point.lon}}],
+            "must_not": [{"exists": {"field": geo_point.name}}],
+        }},
+        conflicts="proceed",
+        slices="auto",
+        wait_for_completion=False,
+    )
+    print(f"Backfilling {geo_point.name} on {index_name}, task {response['task']}")
+
+
+# BioSamples records.
+
+def iter_json(f):
+    # Items of a top level JSON array are decoded one by one, holding about a
+    # chunk of the file in memory. Other documents are loaded whole.
+    decoder = json.JSONDecoder()
+    buffer = f.read(JSON_CHUNK_SIZE).lstrip()
+    if not buffer.startswith("["):
+        yield json.loads(buffer + f.read())
+        return
+    position = 1
+    while True:
+        while position < len(buffer) and buffer[position] in " \t\r\n,":
+            position += 1
+        if position < len(buffer) and buffer[position] == "]":
+            return
+        try:
+            if position == len(buffer):
+                raise json.JSONDecodeError("Need more data", buffer, position)
+            item, position = decoder.raw_decode(buffer, position)
+        except json.JSONDecodeError:
+            # The item continues in the next chunk.
+            chunk = f.read(JSON_CHUNK_SIZE)
+            if not chunk:
+                raise
+            buffer, position = buffer[position:] + chunk, 0
+            continue
+        yield item
+
+
+def read_samples(paths):
+    # NDJSON dumps are streamed line by line, JSON files hold a list of samples,
+    # streamed item by item, or a BioSamples API page. "-" reads NDJSON from
+    # stdin.
+    for path in paths:
+        if path == "-":
+            yield from (orjson.loads(line) for line in sys.stdin if line.strip())
+            continue
+        opener = gzip.open if path.endswith(".gz") else open
+        with opener(path, "rt", encoding="utf-8") as f:
+            if path.removesuffix(".gz").endswith((".ndjson", ".jsonl")):
+                yield from (orjson.loads(line) for line in f if line.strip())
+                continue
+            for item in iter_json(f):
+                yield from item.get("_embedded", {}).get("samples", [item])
+
+
+def characteristic(values):
+    # Text and unit of the first value of a characteristic.
+    value = values[0]
+    return str(value.get("text", "")).strip(), value.get("unit") or ""
+
+
+def parse_coordinate(text):
+    try:
+        return float(text)
+    except ValueError:
+        return None
+
+
+def parse_date(text):
+    # Full dates and times, or the first day of a month or year.
+    try:
+        return datetime.datetime.fromisoformat(text)
+    except ValueError:
+        pass
+    for date_format in ("%Y-%m", "%Y"):
+        try:
+            return datetime.datetime.strptime(text, date_format)
+        except ValueError:
+            continue
+    return None
+
+
+def biosample_to_trec(sample):
+    record = {
+        "biosampleId": sample["accession"],
+        "lat": None,
+        "lon": None,
+        "collection_date": None,
+        "customFields": [],
+        "relationships": [
+            {"source": relationship["source"], "type": relationship["type"],
+             "target": relationship["target"]}
+            for relationship in sample.get("relationships", [])
+        ],
+    }
+    for name, values in sample.get("characteristics", {}).items():
+        if not values:
+            continue
+        text, unit = characteristic(values)
+        if name in BIOSAMPLES_FIELDS:
+            record[BIOSAMPLES_FIELDS[name]] = f"{text} {unit}" if unit else text
+        elif name == BIOSAMPLES_LAT:
+            record["lat"] = parse_coordinate(text)
+        elif name == BIOSAMPLES_LON:
+            record["lon"] = parse_coordinate(text)
+        elif name == BIOSAMPLES_DATE:
+            record["collection_date"] = parse_date(text)
+        else:
+            record["customFields"].append({"name": name, "value": text,
+                                           "unit": unit})
+    for field in BIOSAMPLES_FIELDS.values():
+        record.setdefault(field, BIOSAMPLES_MISSING)
+    return record
+
+
+# Converters from dump records to the records of a data source.
+CONVERTERS = {"data_portal": biosample_to_trec}
+
+
+def to_document(data_source, record):
+    if data_source.updated_field is not None:
+        # Change tracking follows loads, records updated at the source before
+        # the last sync still have to be picked up when they are loaded.
+        record = {**record, data_source.updated_field:
+                  datetime.datetime.now(datetime.timezone.utc)}
+    document = data_source.data_class.model_validate(record).model_dump(mode="json")
+    geo_point = data_source.geo_point
+    if (geo_point is not None and document.get(geo_point.lat) is not None
+            and document.get(geo_point.lon) is not None):
+        # Set here, so that loading can skip the geo pipeline.
+        document[geo_point.name] = {"lat": document[geo_point.lat],
+                                    "lon": document[geo_point.lon]}
+    return document
+
+
+def documents(data_source, samples, stats):
+    # (ID, encoded source) of every valid record, invalid records are skipped.
+    convert = CONVERTERS[data_source.index_name]
+    for sample in samples:
+        try:
+            record = convert(sample)
+            document = to_document(data_source, record)
+        except (KeyError, TypeError, ValueError) as e:
+            stats["skipped"] += 1
+            logger.warning("Skipping %s: %s", sample.get("accession"), e)
+            continue
+        yield record["biosampleId"], orjson.dumps(document)
+
+
+# Bulk loading.
+
+async def send_batch(es_client, index_name, batch, stats, max_retries, backoff):
+    # Rejected items and failed requests are retried with exponential backoff,
+    # other item errors are counted and logged.
+    for attempt in range(max_retries + 1):
+        if attempt:
+            await asyncio.sleep(min(backoff * 2 ** (attempt - 1), 60))
+        operations = []
+        for document_id, source in batch:
+            operations.append(orjson.dumps(
+                {"index": {"_index": index_name, "_id": document_id}}))
+            operations.append(source)
+        try:
+            # Documents already carry their geo point, skip the default pipeline.
+            response = await es_client.bulk(operations=operations,
+                                            pipeline="_none")
+        except Exception as e:
+            if not is_transient(e):
+                raise
+            stats["retried"] += len(batch)
+            continue
+        if not response["errors"]:
+            stats["indexed"] += len(batch)
+            return
+        rejected = []
+        for item, document in zip(response["items"], batch):
+            result = item["index"]
+            if result["status"] in RETRYABLE_STATUSES:
+                rejected.append(document)
+            elif result["status"] >= 300:
+                stats["failed"] += 1
+                logger.warning("Indexing %s failed: %s", document[0],
+                               result.get("error"))
+            else:
+                stats["indexed"] += 1
+        if not rejected:
+            return
+        stats["retried"] += len(rejected)
+        batch = rejected
+    stats["failed"] += len(batch)
+    logger.warning("Giving up on %d documents after %d retries", len(batch),
+                   max_retries)
+
+
+async def bulk_load(es_client, data_source, documents, batch_size, parallelism,
+                    max_retries, backoff, stats):
+    # Batches are sent by `parallelism` concurrent workers, the bounded queue
+    # keeps reading the dump in step with indexing.
+    queue = asyncio.Queue(maxsize=parallelism * 2)
+
+    async def worker():
+        while (batch := await queue.get()) is not None:
+            await send_batch(es_client, data_source.index_name, batch, stats,
+                             max_retries, backoff)
+
+    async with asyncio.TaskGroup() as workers:
+        for _ in range(parallelism):
+            workers.create_task(worker())
+        batch = []
+        for document in documents:
+            batch.append(document)
+            if len(batch) == batch_size:
+                await queue.put(batch)
+                batch = []
+        if batch:
+            await queue.put(batch)
+        for _ in range(parallelism):
+            await queue.put(None)
+
+
+async def load(es_client, data_source, args):
+    index_name = data_source.index_name
+    if args.create and not await es_client.indices.exists(index=index_name):
+        await create_index(es_client, data_source, args.shards, args.replicas)
+    # Refreshing segments while loading slows indexing down, refresh once at
+    # the end instead.
+    response = await es_client.indices.get_settings(index=index_name,
+                                                    flat_settings=True)
+    settings = next(iter(response.values()))["settings"]
+    previous = {name: settings.get(f"index.{name}") for name in LOAD_SETTINGS}
+    await es_client.indices.put_settings(index=index_name, settings=LOAD_SETTINGS)
+    stats = Counter()
+    started = time.perf_counter()
+    try:
+        await bulk_load(
+            es_client, data_source,
+            documents(data_source, read_samples(args.files), stats),
+            args.batch_size, args.parallelism, args.max_retries,
+            INGEST_RETRY_BACKOFF, stats)
+    finally:
+        await es_client.indices.put_settings(index=index_name, settings=previous)
+        await es_client.indices.refresh(index=index_name)
+        elapsed = time.perf_counter() - started
+        print(f"Indexed {stats['indexed']} documents into {index_name} in "
+              f"{elapsed:.0f}s ({stats['indexed'] / max(elapsed, 1e-9):.0f}/s), "
+              f"{stats['failed']} failed, {stats['skipped']} skipped, "
+              f"{stats['retried']} retried")
+    return stats
+
+
+async def run(args):
+    data_source = data_sources[args.index]
+    if args.command == "mapping":
+        print(json.dumps({
+            "settings": index_settings(data_source, args.shards, args.replicas),
+            "mappings": index_mapping(data_source),
+        }, indent=2))
+        return
+    es_client = es_client_from_env()
+    try:
+        if args.command == "create":
+            await create_index(es_client, data_source, args.shards, args.replicas)
+        elif args.command == "load":
+            stats = await load(es_client, data_source, args)
+            if stats["failed"]:
+                raise SystemExit(1)
+        elif args.command == "geo":
+            if data_source.geo_point is None:
+                raise SystemExit(f"{data_source.name} has no geo point")
+            await setup_geo(es_client, data_source)
+    finally:
+        await es_client.close()
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    index_options = argparse.ArgumentParser(add_help=False)
+    index_options.add_argument("--shards", type=int, default=1)
+    index_options.add_argument("--replicas", type=int, default=1)
+
+    mapping = commands.add_parser(
+        "mapping", parents=[index_options],
+        help="print the index settings and mapping derived from the fields")
+    mapping.add_argument("index", choices=sorted(data_sources))
+    create = commands.add_parser(
+        "create", parents=[index_options],
+        help="create the index with the derived settings and mapping")
+    create.add_argument("index", choices=sorted(data_sources))
+    load_parser = commands.add_parser(
+        "load", parents=[index_options],
+        help="bulk load BioSamples JSON or NDJSON dumps, optionally gzipped")
+    load_parser.add_argument("index", choices=sorted(CONVERTERS))
+    load_parser.add_argument("files", nargs="+", help="dump files, - for stdin")
+    load_parser.add_argument("--create", action="store_true",
+                             help="create the index if it does not exist")
+    load_parser.add_argument("--batch-size", type=int, default=INGEST_BATCH_SIZE,
+                             help="documents per bulk request")
+    load_parser.add_argument("--parallelism", type=int, default=INGEST_PARALLELISM,
+                             help="concurrent bulk requests")
+    load_parser.add_argument("--max-retries", type=int, default=INGEST_MAX_RETRIES,
+                             help="retries of rejected documents")
+    geo = commands.add_parser(
+        "geo", help="map the geo point field and backfill it from lat/lon")
+    geo.add_argument("index", choices=sorted(data_sources))
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,22 +1,133 @@
+import asyncio
+import base64
+import binascii
 import os
-import urllib.parse
+import time
 from contextlib import asynccontextmanager
+from contextvars import ContextVar
 import json
 
-from fastapi import FastAPI, HTTPException, Query, Path
-from elasticsearch import AsyncElasticsearch
+import orjson
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
+from fastapi import FastAPI, HTTPException, Query, Path, Request
+from fastapi.responses import Response, StreamingResponse
+from elasticsearch import AsyncElasticsearch, NotFoundError
 from fastapi.middleware.cors import CORSMiddleware
-from collections import defaultdict
-from typing import Annotated
+from fastapi.middleware.gzip import GZipMiddleware
+from typing import Annotated, Literal
 
+from cache import (
+    ResultCache,
+    SingleFlight,
+    canonical_key,
+    canonical_params,
+    etag_matches,
+    strong_etag,
+)
+from metrics import (
+    MetricsMiddleware,
+    observe_es_call,
+    register_stats,
+    registry,
+    timed_endpoint,
+    timed_phase,
+)
+from resilience import CircuitBreaker, CircuitOpenError, Resilience, is_transient
+from export import MEDIA_TYPES, export_stream
 from models import (
-    get_list_of_aggregations,
+    get_field_normalizers,
+    get_optional_fields,
+    get_projected_class,
+    BatchRequest,
     ElasticResponse,
+    ElasticAggregationsResponse,
+    ElasticCountResponse,
     ElasticDetailsResponse,
-    TRECData,
-    TRECSearchParams,
-    TRECAggregationResponse
+    ElasticFacetResponse,
+    ElasticGeoResponse,
+    ElasticSuggestResponse,
+    SuggestParams,
+    data_sources,
+)
+
+
+# Search result cache, invalidated whenever a watched index changes.
+result_cache = ResultCache(
+    max_bytes=int(os.getenv("CACHE_MAX_BYTES", 64 * 1024 * 1024)),
+    ttl=float(os.getenv("CACHE_TTL_SECONDS", 300)),
+)
+# Concurrent identical backend queries share one Elasticsearch call.
+single_flight = SingleFlight()
+# Timeouts, retries and circuit breaking for every Elasticsearch read.
+es_resilience = Resilience(
+    breaker=CircuitBreaker(
+        failure_threshold=int(os.getenv("ES_BREAKER_FAILURES", 5)),
+        reset_timeout=float(os.getenv("ES_BREAKER_RESET_SECONDS", 30)),
+    ),
+    retries=int(os.getenv("ES_MAX_RETRIES", 2)),
+    backoff=float(os.getenv("ES_RETRY_BACKOFF_SECONDS", 0.1)),
+    backoff_max=float(os.getenv("ES_RETRY_BACKOFF_MAX_SECONDS", 2)),
+    timeout_budget=float(os.getenv("ES_TIMEOUT_BUDGET_SECONDS", 15)),
 )
+# Optionally serve the last good response for a query while Elasticsearch
+# is failing.
+STALE_WHILE_ERROR = os.getenv("STALE_WHILE_ERROR", "false").lower() == "true"
+stale_cache = ResultCache(
+    max_bytes=int(os.getenv("STALE_CACHE_MAX_BYTES", 64 * 1024 * 1024)),
+    ttl=float(os.getenv("STALE_CACHE_TTL_SECONDS", 24 * 60 * 60)),
+)
+index_versions = {}
+INDEX_POLL_SECONDS = float(os.getenv("INDEX_POLL_SECONDS", 30))
+# How long a point in time used for cursor pagination is kept between pages.
+PIT_KEEP_ALIVE = os.getenv("PIT_KEEP_ALIVE", "5m")
+# Matches counted by the default 'capped' total hits mode.
+TRACK_TOTAL_HITS_CAP = int(os.getenv("TRACK_TOTAL_HITS_CAP", 10000))
+# Number of documents fetched from Elasticsearch per export page.
+EXPORT_BATCH_SIZE = int(os.getenv("EXPORT_BATCH_SIZE", 1000))
+# Geotile precision is the map zoom plus this offset, so one map tile holds up
+# to 4^offset clusters.
+GEO_TILE_OFFSET = int(os.getenv("GEO_TILE_OFFSET", 2))
+GEO_MAX_CLUSTERS = int(os.getenv("GEO_MAX_CLUSTERS", 10000))
+# Cache-Control and extra Vary headers per route, e.g. CACHE_CONTROL_DETAILS.
+# GZip and CORS already add Vary: Accept-Encoding and Origin where needed.
+ROUTE_CACHE_HEADERS = {
+    route: {
+        name: value for name, value in {
+            "Cache-Control": os.getenv(f"CACHE_CONTROL_{route.upper()}",
+                                       "public, max-age=60"),
+            "Vary": os.getenv(f"VARY_{route.upper()}", ""),
+        }.items() if value
+    }
+    for route in ("search", "aggregations", "count", "facets", "suggest", "geo",
+                  "details")
+}
+
+
+async def get_index_version(es_client, index_name):
+    # Indexing counters change on every write, the UUID changes on reindex.
+    stats = await es_client.indices.stats(index=index_name, metric="indexing")
+    return ",".join(
+        f"{stat.get('uuid', name)}:{stat['primaries']['indexing']['index_total']}:"
+        f"{stat['primaries']['indexing']['delete_total']}"
+        for name, stat in sorted(stats["indices"].items())
+    )
+
+
+async def watch_index_versions(es_client):
+    while True:
+        for index_name in data_sources:
+            try:
+                version = await get_index_version(es_client, index_name)
+            except Exception:
+                # Keep serving from cache, the TTL still bounds staleness, but
+                # without ETags, which would claim an index version that may
+                # be outdated.
+                index_versions.pop(index_name, None)
+                continue
+            if index_versions.get(index_name) != version:
+                index_versions[index_name] = version
+                result_cache.invalidate(index_name)
+        await asyncio.sleep(INDEX_POLL_SECONDS)
 
 
 @asynccontextmanager
@@ -26,10 +137,17 @@ async def lifespan(app: FastAPI):
         [os.getenv("ES_URL")],
         http_auth=(os.getenv("ES_USERNAME"), os.getenv("ES_PASSWORD")),
         verify_certs=True,
+        # Per attempt timeout and pool size, retries are done by es_resilience.
+        request_timeout=float(os.getenv("ES_REQUEST_TIMEOUT_SECONDS", 10)),
+        connections_per_node=int(os.getenv("ES_CONNECTIONS_PER_NODE", 10)),
+        max_retries=0,
     )
     # Pass the client to the app's state so it's accessible in routes.
     app.state.es_client = es_client
+    # Watch indices in the background to invalidate cached results.
+    watcher = asyncio.create_task(watch_index_versions(es_client))
     yield
+    watcher.cancel()
     # Clean up by closing the Elasticsearch client.
     await es_client.close()
 
@@ -54,108 +172,833 @@ app.add_middleware(
     allow_headers=["*"],  # Allows all headers
 )
 
+# Compress large responses for clients accepting gzip.
+app.add_middleware(GZipMiddleware,
+                   minimum_size=int(os.getenv("GZIP_MINIMUM_SIZE", 1000)))
+
+# Outermost, so latency and sizes cover everything the client sees.
+app.add_middleware(MetricsMiddleware)
+register_stats("cache", result_cache.stats, {"hits", "misses", "evictions"})
+register_stats("stale_cache", stale_cache.stats, {"hits", "misses", "evictions"})
+register_stats("single_flight", single_flight.stats, {"calls", "collapsed"})
+register_stats("es", es_resilience.stats, {"breaker_trips", "retries"})
+
+
+# Elasticsearch call helpers.
+
+async def es_call(method, **kwargs):
+    started = time.perf_counter()
+    with timed_phase("es"):
+        response = await es_resilience.call(lambda: method(**kwargs))
+    observe_es_call(method.__name__, response, time.perf_counter() - started)
+    return response
+
+
+def search_error(e):
+    # Map Elasticsearch errors to HTTP errors.
+    if isinstance(e, HTTPException):
+        return e
+    if isinstance(e, CircuitOpenError):
+        return HTTPException(status_code=503, detail=f"Search unavailable: {str(e)}")
+    if isinstance(e, asyncio.TimeoutError):
+        return HTTPException(status_code=504, detail="Search timed out")
+    if is_transient(e):
+        return HTTPException(status_code=503, detail=f"Search unavailable: {str(e)}")
+    return HTTPException(status_code=500, detail=f"Search error: {str(e)}")
+
+
+# Set when the request was answered from the stale cache.
+served_stale: ContextVar[bool] = ContextVar("served_stale", default=False)
+
+
+async def with_stale_fallback(key, index_name, function):
+    # Remember the last good response per key and serve it on backend errors.
+    try:
+        results = await function()
+    except HTTPException as e:
+        stale = stale_cache.get(key) if STALE_WHILE_ERROR else None
+        if stale is None or e.status_code < 500:
+            raise
+        served_stale.set(True)
+        return stale
+    if STALE_WHILE_ERROR:
+        stale_cache.set(key, index_name, results, size=response_size(results))
+    return results
+
+
+# Request keys, shared by the result cache, single flight and ETags.
+
+def search_key(data_source, params):
+    return canonical_key(data_source.index_name, canonical_params(params))
+
+
+def aggregations_key(data_source, params):
+    # Facet counts only depend on the query and filters, not on paging or sort.
+    # The filters are taken from their generated class, so that no param
+    # selecting records can be missed.
+    return canonical_key(
+        data_source.index_name, "aggregations",
+        canonical_params(params, include={
+            *data_source.filter_params_class.model_fields, "track_total_hits"}))
+
+
+# Count, facet and geo params only hold the filters and their own options.
+
+def count_key(data_source, params):
+    return canonical_key(data_source.index_name, "count", canonical_params(params))
+
+
+def facets_key(data_source, field, params):
+    return canonical_key(data_source.index_name, "facets", field,
+                         canonical_params(params))
+
+
+def geo_key(data_source, params):
+    return canonical_key(data_source.index_name, "geo", canonical_params(params))
+
+
+def suggest_key(data_source, params):
+    return canonical_key(data_source.index_name, "suggest", params.model_dump())
+
+
+def details_key(data_source, record_id, params):
+    return canonical_key(data_source.index_name, "details", record_id,
+                         params.model_dump())
+
+
+# Conditional requests.
+
+async def conditional_get(request, response, data_source, route, key, function):
+    # Responses only change with the index, so the ETag is known before running
+    # the query. Like the result cache, it follows writes within
+    # INDEX_POLL_SECONDS. A key of None marks a response that is not cacheable.
+    headers = ({"Cache-Control": "no-store"} if key is None
+               else dict(ROUTE_CACHE_HEADERS[route]))
+    version = index_versions.get(data_source.index_name)
+    if key is not None and version is not None:
+        # Gzip and identity encoded bodies need different strong ETags.
+        gzip = "gzip" in request.headers.get("accept-encoding", "")
+        headers["ETag"] = strong_etag(version, route, key, gzip)
+        if etag_matches(request.headers.get("if-none-match"), headers["ETag"]):
+            return Response(status_code=304, headers=headers)
+    served_stale.set(False)
+    results = await function()
+    if served_stale.get() or index_versions.get(data_source.index_name) != version:
+        # The body may come from another index version than the ETag, it
+        # must not be revalidated or cached.
+        headers.pop("ETag", None)
+        headers["Cache-Control"] = "no-store"
+    # Returned responses bypass the headers set on the injected response.
+    target = results if isinstance(results, Response) else response
+    target.headers.update(headers)
+    return results
+
+
+# Cursor pagination helpers.
+
+def encode_cursor(pit_id, search_after, start):
+    cursor = json.dumps({"pit": pit_id, "after": search_after, "start": start})
+    return base64.urlsafe_b64encode(cursor.encode()).decode()
+
+
+def decode_cursor(cursor):
+    try:
+        decoded = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return decoded["pit"], decoded["after"], decoded["start"]
+    except (binascii.Error, ValueError, TypeError, KeyError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+# Trusted fast path helpers.
+
+def normalize_hits(hits, data_class, fields=None):
+    # Trusted hits are passed through as stored, except for missing optional
+    # fields and fields whose JSON form would differ from the validated
+    # response.
+    normalizers = get_field_normalizers(data_class)
+    optional = [name for name in get_optional_fields(data_class)
+                if fields is None or name in fields]
+    if normalizers or optional:
+        for hit in hits:
+            for name in optional:
+                hit.setdefault(name, None)
+            for name, normalize in normalizers.items():
+                if hit.get(name) is not None:
+                    hit[name] = normalize(hit[name])
+    return hits
+
+
+def json_response(content):
+    return Response(content=content, media_type="application/json")
+
+
+def response_size(results):
+    if isinstance(results, bytes):
+        return len(results)
+    return len(results.model_dump_json())
+
 
 # Generic search methods.
 
-async def elastic_search(index_name, params, data_class, aggregation_class):
+def build_query(params, data_source):
     # Build the query body based on whether there is full text search.
     if params.q:
         query_body = {
-            "multi_match": {"query": params.q, "fields": ["*"], "operator": "and", "fuzziness": "AUTO"},}
+            "multi_match": {"query": params.q, "fields": data_source.search_fields,
+                            "operator": "and"}}
+        # Exact and prefix matches skip the expensive fuzzy term expansion.
+        if params.match == "fuzzy":
+            query_body["multi_match"]["fuzziness"] = "AUTO"
+        elif params.match == "prefix":
+            query_body["multi_match"]["type"] = "bool_prefix"
     else:
         query_body = {"match_all": {}}
 
     # Adding filters.
     filters = []
-    aggregation_fields = get_list_of_aggregations(aggregation_class)
-    if aggregation_fields:
-        for aggregation_field in aggregation_fields:
-            filter_value = getattr(params, aggregation_field)
-            if filter_value:
-                filters.append({"terms": {aggregation_field: [filter_value]}})
-
-    # Combine query with filters.
-    search_body = {
-        "from": params.start,
-        "size": params.size,
-        "query": {
-            "bool": {
-                "must": query_body,
-                "filter": filters,
-            }
-        },
-        "aggs": defaultdict(dict),
+    for aggregation_field in data_source.aggregation_fields:
+        filter_value = getattr(params, aggregation_field)
+        if filter_value:
+            filters.append({"terms": {aggregation_field: [filter_value]}})
+
+    # Adding geo filters.
+    if data_source.geo_point is not None:
+        filters.extend(build_geo_filters(params, data_source.geo_point.name))
+
+    # Adding the updated since filter.
+    if data_source.updated_field is not None and params.updated_since:
+        filters.append({"range": {data_source.updated_field: {
+            "gte": params.updated_since.isoformat()}}})
+
+    return {
+        "bool": {
+            "must": query_body,
+            "filter": filters,
+        }
     }
 
-    # Adding aggregation fields.
-    if aggregation_fields:
-        for aggregation_field in aggregation_fields:
-            search_body["aggs"][aggregation_field] = {
-                "terms": {"field": aggregation_field, "size": 100}
-            }
 
-    # Adding sort field and sort order
-    search_body["sort"] = [{params.sort_field: {"order": params.sort_order}}]
+def build_track_total_hits(params):
+    return {"exact": True, "capped": TRACK_TOTAL_HITS_CAP,
+            "off": False}[params.track_total_hits]
+
+
+def hits_total(response):
+    # Total and its relation, None when counting was turned off.
+    total = response["hits"].get("total")
+    if total is None:
+        return None, None
+    return total["value"], total["relation"]
+
+
+def build_bounds(bbox):
+    west, south, east, north = bbox
+    return {"top_left": {"lat": north, "lon": west},
+            "bottom_right": {"lat": south, "lon": east}}
+
+
+def build_geo_filters(params, field):
+    filters = []
+    if params.bbox:
+        filters.append({"geo_bounding_box": {field: build_bounds(params.bbox)}})
+    if params.polygon:
+        ring = [params.polygon[i:i + 2] for i in range(0, len(params.polygon), 2)]
+        if ring[0] != ring[-1]:
+            ring.append(ring[0])
+        filters.append({"geo_shape": {field: {
+            "shape": {"type": "polygon", "coordinates": [ring]},
+            "relation": "intersects",
+        }}})
+    return filters
+
+
+def build_source(params, data_source, trusted=False):
+    # Only fetch the projected fields from Elasticsearch. Trusted responses are
+    # not validated, so they must not pick up fields outside the data class.
+    if params.fields:
+        return {"_source": params.fields}
+    if trusted:
+        return {"_source": data_source.source_fields}
+    return {}
+
+
+def build_sort(params):
+    sort = []
+    if params.sort_field:
+        sort.append({params.sort_field: {"order": params.sort_order}})
+    return sort
+
+
+async def elastic_search(data_source, params):
+    # Serve repeated searches from the result cache, cursor pages are bound to
+    # a point in time and are never cached.
+    cache_key = search_key(data_source, params)
+    results = result_cache.get(cache_key) if not params.cursor else None
+    if results is None:
+        results = await with_stale_fallback(
+            cache_key, data_source.index_name,
+            lambda: single_flight.run(
+                cache_key, lambda: fetch_search(data_source, params, cache_key)))
+    return json_response(results) if data_source.trusted else results
+
+
+async def fetch_search(data_source, params, cache_key):
+    index_name = data_source.index_name
+    trusted = data_source.trusted
+    with timed_phase("build"):
+        # Combine query with filters.
+        search_body = {
+            "from": params.start,
+            "size": params.size,
+            "track_total_hits": build_track_total_hits(params),
+            "query": build_query(params, data_source),
+            **build_source(params, data_source, trusted),
+        }
+
+        # Adding precompiled aggregation fields.
+        if params.aggregations:
+            search_body["aggs"] = data_source.aggregations
+
+        # Adding sort field and sort order
+        search_body["sort"] = build_sort(params)
+
+    # Cursor pagination continues from the last sort values of the previous
+    # page inside a point in time, so deep pages cost the same as the first.
+    start = params.start
+    if params.cursor and params.cursor != "*":
+        pit_id, search_after, start = decode_cursor(params.cursor)
+        del search_body["from"]
+        search_body["search_after"] = search_after
 
     # Performing the search.
     try:
-        # Execute the async search request.
-        response = await app.state.es_client.search(index=index_name, body=search_body)
+        if params.cursor:
+            if params.cursor == "*":
+                pit = await es_call(app.state.es_client.open_point_in_time,
+                                    index=index_name, keep_alive=PIT_KEEP_ALIVE)
+                pit_id = pit["id"]
+            search_body["pit"] = {"id": pit_id, "keep_alive": PIT_KEEP_ALIVE}
+            # Tie-breaker for documents sharing the same sort value.
+            search_body["sort"].append({"_shard_doc": "asc"})
+            response = await es_call(app.state.es_client.search,
+                                     body=search_body)
+        else:
+            # Execute the async search request.
+            response = await es_call(app.state.es_client.search,
+                                     index=index_name, body=search_body)
         # Extract total count and hits.
-        total = response["hits"]["total"]["value"]
+        total, total_relation = hits_total(response)
         hits = [r["_source"] for r in response["hits"]["hits"]]
-        aggregations = response["aggregations"]
-        # Return the results.
-        return ElasticResponse[data_class, aggregation_class](
-            total=total,
-            start=params.start,
-            size=params.size,
-            results=hits,
-            aggregations=aggregations,
-        )
+        aggregations = response.get("aggregations")
+
+        # Point to the next page, or release the point in time after the last one.
+        next_cursor = None
+        if params.cursor:
+            if len(hits) == params.size:
+                next_cursor = encode_cursor(
+                    response["pit_id"], response["hits"]["hits"][-1]["sort"],
+                    start + len(hits))
+            else:
+                await es_call(app.state.es_client.close_point_in_time,
+                              id=response["pit_id"])
+
+        if trusted:
+            # Encode the Elasticsearch response as is, skipping validation.
+            with timed_phase("encode"):
+                results = orjson.dumps({
+                    "total": total,
+                    "total_relation": total_relation,
+                    "start": start,
+                    "size": params.size,
+                    "results": normalize_hits(hits, data_source.data_class,
+                                              params.fields),
+                    "aggregations": aggregations,
+                    "next_cursor": next_cursor,
+                })
+        else:
+            projected_class = get_projected_class(
+                data_source.data_class,
+                tuple(params.fields) if params.fields else None)
+            with timed_phase("validate"):
+                results = ElasticResponse[projected_class,
+                                          data_source.aggregation_class](
+                    total=total,
+                    total_relation=total_relation,
+                    start=start,
+                    size=params.size,
+                    results=hits,
+                    aggregations=aggregations,
+                    next_cursor=next_cursor,
+                )
+    except Exception as e:
+        # Handle Elasticsearch errors.
+        raise search_error(e)
 
+    # Cache and return the results.
+    if not params.cursor:
+        result_cache.set(cache_key, index_name, results,
+                         size=response_size(results))
+    return results
+
+
+async def elastic_aggregations(data_source, params):
+    index_name = data_source.index_name
+    cache_key = aggregations_key(data_source, params)
+    results = result_cache.get(cache_key)
+    if results is None:
+        results = await with_stale_fallback(
+            cache_key, index_name,
+            lambda: fetch_aggregations(data_source, params, cache_key))
+    return results
+
+
+async def fetch_aggregations(data_source, params, cache_key):
+    index_name = data_source.index_name
+    search_body = {
+        "size": 0,
+        "track_total_hits": build_track_total_hits(params),
+        "query": build_query(params, data_source),
+        "aggs": data_source.aggregations,
+    }
+    try:
+        response = await es_call(app.state.es_client.search,
+                                 index=index_name, body=search_body)
+        total, total_relation = hits_total(response)
+        with timed_phase("validate"):
+            results = ElasticAggregationsResponse[data_source.aggregation_class](
+                total=total,
+                total_relation=total_relation,
+                aggregations=response["aggregations"],
+            )
     except Exception as e:
         # Handle Elasticsearch errors.
-        raise HTTPException(status_code=500, detail=f"Search error: {str(e)}")
+        raise search_error(e)
+
+    result_cache.set(cache_key, index_name, results,
+                     size=response_size(results))
+    return results
+
 
+async def elastic_count(data_source, params):
+    index_name = data_source.index_name
+    cache_key = count_key(data_source, params)
+    results = result_cache.get(cache_key)
+    if results is None:
+        results = await with_stale_fallback(
+            cache_key, index_name,
+            lambda: single_flight.run(
+                cache_key, lambda: fetch_count(data_source, params, cache_key)))
+    return results
 
-async def elastic_details(index_name, record_id, data_class):
+
+async def fetch_count(data_source, params, cache_key):
+    index_name = data_source.index_name
     try:
-        # Quote the request, except for colons; they might appear in IDs.
-        quoted_id = urllib.parse.quote(record_id).replace("%3A", ":")
-        if ":" in quoted_id:
-            quoted_id = '"' + quoted_id + '"'
-        response = await app.state.es_client.search(
-            index=index_name, query={"term": {"_id": quoted_id}}
-        )
-        hits = [r["_source"] for r in response["hits"]["hits"]]
-        return ElasticDetailsResponse[data_class](results=hits)
+        # The count API skips scoring, hits and aggregations altogether.
+        response = await es_call(app.state.es_client.count, index=index_name,
+                                 query=build_query(params, data_source))
+        results = ElasticCountResponse(count=response["count"])
     except Exception as e:
         # Handle Elasticsearch errors.
-        raise HTTPException(status_code=500, detail=f"Search error: {str(e)}")
+        raise search_error(e)
 
+    result_cache.set(cache_key, index_name, results,
+                     size=response_size(results))
+    return results
 
-# MaveDB.
 
+async def elastic_facets(data_source, field, params):
+    index_name = data_source.index_name
+    cache_key = facets_key(data_source, field, params)
+    results = result_cache.get(cache_key)
+    if results is None:
+        results = await with_stale_fallback(
+            cache_key, index_name,
+            lambda: fetch_facets(data_source, field, params, cache_key))
+    return results
 
-@app.get("/data_portal")
-async def trec_search(
-        params: Annotated[TRECSearchParams, Query()],
-) -> ElasticResponse[TRECData, TRECAggregationResponse]:
-    return await elastic_search(
-        index_name="data_portal",
-        params=params,
-        data_class=TRECData,
-        aggregation_class=TRECAggregationResponse,
-    )
 
+async def fetch_facets(data_source, field, params, cache_key):
+    index_name = data_source.index_name
+    size = params.size or data_source.facet_sizes[field]
+    query = build_query(params, data_source)
+    if params.prefix:
+        # Only documents with a matching value contribute buckets.
+        query["bool"]["filter"].append({"prefix": {field: {
+            "value": params.prefix, "case_insensitive": True}}})
+    # Composite buckets come in key order and are paged with an after key,
+    # instead of computing the top buckets of the whole field.
+    composite = {"size": size, "sources": [{field: {"terms": {"field": field}}}]}
+    if params.after is not None:
+        composite["after"] = {field: params.after}
+    search_body = {
+        "size": 0,
+        "track_total_hits": False,
+        "query": query,
+        "aggs": {field: {"composite": composite}},
+    }
+    try:
+        response = await es_call(app.state.es_client.search,
+                                 index=index_name, body=search_body)
+        aggregation = response["aggregations"][field]
+        buckets = aggregation["buckets"]
+        after_key = aggregation.get("after_key")
+        with timed_phase("validate"):
+            results = ElasticFacetResponse(
+                field=field,
+                buckets=[{"key": bucket["key"][field],
+                          "doc_count": bucket["doc_count"]} for bucket in buckets],
+                after=(str(after_key[field])
+                       if after_key and len(buckets) == size else None),
+            )
+    except Exception as e:
+        # Handle Elasticsearch errors.
+        raise search_error(e)
 
-@app.get("/data_portal/{record_id}")
-async def trec_details(
-        record_id: Annotated[str, Path(description="Record ID")],
-) -> ElasticDetailsResponse[TRECData]:
-    return await elastic_details(
-        index_name="data_portal",
-        record_id=record_id,
-        data_class=TRECData,
+    result_cache.set(cache_key, index_name, results,
+                     size=response_size(results))
+    return results
+
+
+async def elastic_geo(data_source, params):
+    index_name = data_source.index_name
+    cache_key = geo_key(data_source, params)
+    results = result_cache.get(cache_key)
+    if results is None:
+        results = await with_stale_fallback(
+            cache_key, index_name,
+            lambda: fetch_geo(data_source, params, cache_key))
+    return results
+
+
+async def fetch_geo(data_source, params, cache_key):
+    index_name = data_source.index_name
+    field = data_source.geo_point.name
+    precision = min(params.zoom + GEO_TILE_OFFSET, 29)
+    # Cluster counts per geotile, positioned at the centroid of their samples.
+    grid = {"field": field, "precision": precision, "size": GEO_MAX_CLUSTERS}
+    if params.bbox:
+        # Only build cells inside the viewport.
+        grid["bounds"] = build_bounds(params.bbox)
+    search_body = {
+        "size": 0,
+        "query": build_query(params, data_source),
+        # The grid visits every match anyway, count them all.
+        "track_total_hits": True,
+        "aggs": {
+            "clusters": {
+                "geotile_grid": grid,
+                "aggs": {"centroid": {"geo_centroid": {"field": field}}},
+            }
+        },
+    }
+    try:
+        response = await es_call(app.state.es_client.search,
+                                 index=index_name, body=search_body)
+        with timed_phase("validate"):
+            results = ElasticGeoResponse(
+                total=response["hits"]["total"]["value"],
+                precision=precision,
+                clusters=[
+                    {"key": bucket["key"], "count": bucket["doc_count"],
+                     **bucket["centroid"]["location"]}
+                    for bucket in response["aggregations"]["clusters"]["buckets"]
+                ],
+            )
+    except Exception as e:
+        # Handle Elasticsearch errors.
+        raise search_error(e)
+
+    result_cache.set(cache_key, index_name, results,
+                     size=response_size(results))
+    return results
+
+
+async def export_batches(pit_id, params, data_source):
+    # Walk the point in time page by page, holding one page in memory at a time.
+    search_after = None
+    try:
+        while True:
+            search_body = {
+                "size": EXPORT_BATCH_SIZE,
+                "query": build_query(params, data_source),
+                "pit": {"id": pit_id, "keep_alive": PIT_KEEP_ALIVE},
+                "sort": build_sort(params) + [{"_shard_doc": "asc"}],
+                "track_total_hits": False,
+                **build_source(params, data_source, trusted=True),
+            }
+            if search_after is not None:
+                search_body["search_after"] = search_after
+            response = await es_call(app.state.es_client.search,
+                                     body=search_body)
+            pit_id = response["pit_id"]
+            hits = response["hits"]["hits"]
+            if hits:
+                yield [r["_source"] for r in hits]
+            if len(hits) < EXPORT_BATCH_SIZE:
+                break
+            search_after = hits[-1]["sort"]
+    finally:
+        await es_call(app.state.es_client.close_point_in_time, id=pit_id)
+
+
+async def elastic_export(data_source, params):
+    index_name = data_source.index_name
+    try:
+        pit = await es_call(app.state.es_client.open_point_in_time,
+                            index=index_name, keep_alive=PIT_KEEP_ALIVE)
+    except Exception as e:
+        # Handle Elasticsearch errors.
+        raise search_error(e)
+    batches = export_batches(pit["id"], params, data_source)
+    return StreamingResponse(
+        export_stream(params.format, batches, data_source.data_class,
+                      params.fields),
+        media_type=MEDIA_TYPES[params.format],
+        headers={"Content-Disposition":
+                 f'attachment; filename="{index_name}.{params.format}"'},
     )
+
+
+async def elastic_suggest(data_source, params):
+    index_name = data_source.index_name
+    cache_key = suggest_key(data_source, params)
+    cached = result_cache.get(cache_key)
+    if cached is not None:
+        return cached
+
+    # Completion suggesters are served from in-memory FSTs, no query phase.
+    search_body = {
+        "_source": False,
+        "suggest": {
+            field: {
+                "prefix": params.q,
+                "completion": {"field": f"{field}.suggest", "size": params.size,
+                               "skip_duplicates": True},
+            }
+            for field in data_source.suggest_fields
+        },
+    }
+    try:
+        response = await es_call(app.state.es_client.search,
+                                 index=index_name, body=search_body)
+        options = [
+            (option["_score"], field, option["text"])
+            for field, suggestions in response["suggest"].items()
+            for suggestion in suggestions
+            for option in suggestion["options"]
+        ]
+        options.sort(key=lambda option: -option[0])
+        results = ElasticSuggestResponse(results=[
+            {"field": field, "text": text}
+            for _, field, text in options[:params.size]
+        ])
+    except Exception as e:
+        # Handle Elasticsearch errors.
+        raise search_error(e)
+
+    result_cache.set(cache_key, index_name, results,
+                     size=response_size(results))
+    return results
+
+
+def details_results(hits, params, data_source):
+    if data_source.trusted:
+        with timed_phase("encode"):
+            return orjson.dumps(
+                {"results": normalize_hits(hits, data_source.data_class,
+                                           params.fields)})
+    projected_class = get_projected_class(
+        data_source.data_class, tuple(params.fields) if params.fields else None)
+    with timed_phase("validate"):
+        return ElasticDetailsResponse[projected_class](results=hits)
+
+
+async def elastic_details(data_source, record_id, params):
+    # Identical concurrent lookups share one Elasticsearch call.
+    key = details_key(data_source, record_id, params)
+    results = await with_stale_fallback(
+        key, data_source.index_name,
+        lambda: single_flight.run(
+            key, lambda: fetch_details(data_source, record_id, params)))
+    return json_response(results) if data_source.trusted else results
+
+
+async def fetch_details(data_source, record_id, params):
+    source = build_source(params, data_source, data_source.trusted).get("_source")
+    try:
+        # Real-time get by ID, skipping the query phase.
+        response = await es_call(
+            app.state.es_client.get,
+            index=data_source.index_name, id=record_id, source_includes=source)
+        hits = [response["_source"]]
+    except NotFoundError:
+        hits = []
+    except Exception as e:
+        # Handle Elasticsearch errors.
+        raise search_error(e)
+    return details_results(hits, params, data_source)
+
+
+async def elastic_batch(data_source, record_ids, params):
+    source = build_source(params, data_source, data_source.trusted).get("_source")
+    try:
+        # Resolve all IDs in a single round trip, keeping the requested order.
+        response = await es_call(
+            app.state.es_client.mget,
+            index=data_source.index_name, ids=record_ids, source_includes=source)
+        hits = [doc["_source"] for doc in response["docs"] if doc.get("found")]
+        results = details_results(hits, params, data_source)
+    except Exception as e:
+        # Handle Elasticsearch errors.
+        raise search_error(e)
+    return json_response(results) if data_source.trusted else results
+
+
+# Cache.
+
+
+@app.get("/cache/stats")
+async def cache_stats() -> dict:
+    return {**result_cache.stats(), "index_versions": index_versions,
+            "single_flight": single_flight.stats(),
+            "stale": stale_cache.stats(), "resilience": es_resilience.stats()}
+
+
+# Metrics.
+
+
+@app.get("/metrics", include_in_schema=False)
+async def metrics():
+    return Response(content=generate_latest(registry),
+                    media_type=CONTENT_TYPE_LATEST)
+
+
+# Data source routes.
+
+
+def mount_data_source(app, data_source):
+    # Search, aggregations, count, facets, suggest, geo, export, batch and
+    # details routes for one source.
+    prefix = f"/{data_source.index_name}"
+    tags = [data_source.name]
+
+    @app.get(prefix, response_model_exclude_unset=True, tags=tags,
+             summary=f"{data_source.name} search")
+    @timed_endpoint
+    async def search(
+            request: Request,
+            response: Response,
+            params: Annotated[data_source.search_params_class, Query()],
+    ) -> ElasticResponse[data_source.partial_data_class,
+                         data_source.aggregation_class]:
+        # Cursor pages live in a point in time and are never cached.
+        key = None if params.cursor else search_key(data_source, params)
+        return await conditional_get(
+            request, response, data_source, "search", key,
+            lambda: elastic_search(data_source, params))
+
+    @app.get(f"{prefix}/aggregations", tags=tags,
+             summary=f"{data_source.name} aggregations")
+    @timed_endpoint
+    async def aggregations(
+            request: Request,
+            response: Response,
+            params: Annotated[data_source.search_params_class, Query()],
+    ) -> ElasticAggregationsResponse[data_source.aggregation_class]:
+        return await conditional_get(
+            request, response, data_source, "aggregations",
+            aggregations_key(data_source, params),
+            lambda: elastic_aggregations(data_source, params))
+
+    @app.get(f"{prefix}/count", tags=tags,
+             summary=f"{data_source.name} count")
+    @timed_endpoint
+    async def count(
+            request: Request,
+            response: Response,
+            params: Annotated[data_source.filter_params_class, Query()],
+    ) -> ElasticCountResponse:
+        return await conditional_get(
+            request, response, data_source, "count",
+            count_key(data_source, params),
+            lambda: elastic_count(data_source, params))
+
+    if data_source.aggregation_fields:
+        @app.get(prefix + "/facets/{field}", tags=tags,
+                 summary=f"{data_source.name} facet buckets")
+        @timed_endpoint
+        async def facets(
+                request: Request,
+                response: Response,
+                field: Annotated[Literal[tuple(data_source.aggregation_fields)],
+                                 Path(description="Facet field")],
+                params: Annotated[data_source.facet_params_class, Query()],
+        ) -> ElasticFacetResponse:
+            return await conditional_get(
+                request, response, data_source, "facets",
+                facets_key(data_source, field, params),
+                lambda: elastic_facets(data_source, field, params))
+
+    if data_source.suggest_fields:
+        @app.get(f"{prefix}/suggest", tags=tags,
+                 summary=f"{data_source.name} typeahead suggestions")
+        @timed_endpoint
+        async def suggest(
+                request: Request,
+                response: Response,
+                params: Annotated[SuggestParams, Query()],
+        ) -> ElasticSuggestResponse:
+            return await conditional_get(
+                request, response, data_source, "suggest",
+                suggest_key(data_source, params),
+                lambda: elastic_suggest(data_source, params))
+
+    if data_source.geo_point is not None:
+        @app.get(f"{prefix}/geo", tags=tags,
+                 summary=f"{data_source.name} geotile clusters")
+        @timed_endpoint
+        async def geo(
+                request: Request,
+                response: Response,
+                params: Annotated[data_source.geo_params_class, Query()],
+        ) -> ElasticGeoResponse:
+            return await conditional_get(
+                request, response, data_source, "geo",
+                geo_key(data_source, params),
+                lambda: elastic_geo(data_source, params))
+
+    @app.get(f"{prefix}/export", response_class=StreamingResponse, tags=tags,
+             summary=f"{data_source.name} export")
+    @timed_endpoint
+    async def export(
+            params: Annotated[data_source.export_params_class, Query()],
+    ):
+        return await elastic_export(data_source, params)
+
+    @app.post(f"{prefix}/batch", response_model_exclude_unset=True, tags=tags,
+              summary=f"{data_source.name} batch details")
+    @timed_endpoint
+    async def batch(
+            request: BatchRequest,
+            params: Annotated[data_source.projection_params_class, Query()],
+    ) -> ElasticDetailsResponse[data_source.partial_data_class]:
+        return await elastic_batch(data_source, request.ids, params)
+
+    @app.get(prefix + "/{record_id}", response_model_exclude_unset=True,
+             tags=tags, summary=f"{data_source.name} details")
+    @timed_endpoint
+    async def details(
+            request: Request,
+            response: Response,
+            record_id: Annotated[str, Path(description="Record ID")],
+            params: Annotated[data_source.projection_params_class, Query()],
+    ) -> ElasticDetailsResponse[data_source.partial_data_class]:
+        return await conditional_get(
+            request, response, data_source, "details",
+            details_key(data_source, record_id, params),
+            lambda: elastic_details(data_source, record_id, params))
+
+
+for registered_data_source in data_sources.values():
+    mount_data_source(app, registered_data_source)
@@ -0,0 +1,148 @@
+import functools
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from prometheus_client import CollectorRegistry, Counter, Histogram
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+from starlette.datastructures import MutableHeaders
+
+registry = CollectorRegistry()
+
+REQUEST_LATENCY = Histogram(
+    "trec_request_duration_seconds", "Request latency until the response starts",
+    ["method", "route", "status"], registry=registry)
+RESPONSE_SIZE = Histogram(
+    "trec_response_size_bytes", "Response body size as sent to the client",
+    ["method", "route"], registry=registry,
+    buckets=(256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216))
+REQUEST_ERRORS = Counter(
+    "trec_request_errors_total", "Requests answered with an error status",
+    ["method", "route", "status"], registry=registry)
+ES_TOOK = Histogram(
+    "trec_es_took_seconds", "Query time reported by Elasticsearch ('took')",
+    ["operation"], registry=registry)
+ES_WALL = Histogram(
+    "trec_es_wall_seconds", "Wall time of Elasticsearch calls, including network",
+    ["operation"], registry=registry)
+
+
+class StatsCollector:
+    """Expose counters and gauges from `stats()` dicts of in-process helpers."""
+
+    def __init__(self, name: str, stats, counters: set[str]):
+        self.name = name
+        self.stats = stats
+        self.counters = counters
+
+    def collect(self):
+        for key, value in self.stats().items():
+            if not isinstance(value, (int, float)):
+                continue
+            metric_name = f"trec_{self.name}_{key}"
+            if key in self.counters:
+                metric = CounterMetricFamily(metric_name, f"{self.name} {key}")
+            else:
+                metric = GaugeMetricFamily(metric_name, f"{self.name} {key}")
+            metric.add_metric([], value)
+            yield metric
+
+
+def register_stats(name, stats, counters):
+    registry.register(StatsCollector(name, stats, counters))
+
+
+# Per request phase timings, reported in the Server-Timing header.
+
+class RequestTiming:
+    def __init__(self):
+        self.phases = {}
+        self.handler_end = None
+
+    def add(self, phase, seconds):
+        self.phases[phase] = self.phases.get(phase, 0) + seconds
+
+    def header(self):
+        return ", ".join(f"{phase};dur={seconds * 1000:.1f}"
+                         for phase, seconds in self.phases.items())
+
+
+current_timing: ContextVar[RequestTiming | None] = ContextVar(
+    "current_timing", default=None)
+
+
+@contextmanager
+def timed_phase(phase):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        timing = current_timing.get()
+        if timing is not None:
+            timing.add(phase, time.perf_counter() - started)
+
+
+def observe_es_call(operation, response, seconds):
+    ES_WALL.labels(operation).observe(seconds)
+    if "took" in response:
+        ES_TOOK.labels(operation).observe(response["took"] / 1000)
+
+
+def timed_endpoint(function):
+    # Mark the end of the handler, whatever happens after it until the
+    # response starts is response validation and encoding.
+    @functools.wraps(function)
+    async def wrapper(*args, **kwargs):
+        try:
+            return await function(*args, **kwargs)
+        finally:
+            timing = current_timing.get()
+            if timing is not None:
+                timing.handler_end = time.perf_counter()
+    return wrapper
+
+
+class MetricsMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        timing = RequestTiming()
+        token = current_timing.set(timing)
+        started = time.perf_counter()
+        status = 500
+        size = 0
+
+        async def send_with_metrics(message):
+            nonlocal status, size
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                now = time.perf_counter()
+                if timing.handler_end is not None:
+                    timing.add("encode", now - timing.handler_end)
+                timing.add("total", now - started)
+                REQUEST_LATENCY.labels(scope["method"], route_path(scope),
+                                       status).observe(now - started)
+                MutableHeaders(scope=message).append("Server-Timing",
+                                                     timing.header())
+            elif message["type"] == "http.response.body":
+                size += len(message.get("body", b""))
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_metrics)
+        finally:
+            current_timing.reset(token)
+            route = route_path(scope)
+            RESPONSE_SIZE.labels(scope["method"], route).observe(size)
+            if status >= 400:
+                REQUEST_ERRORS.labels(scope["method"], route, status).inc()
+
+
+def route_path(scope):
+    # Label by route template to keep the metrics cardinality bounded.
+    route = scope.get("route")
+    return route.path if route is not None else "unmatched"
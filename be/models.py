@@ -1,8 +1,16 @@
 import datetime
+import functools
 import types
 
-from pydantic import BaseModel, Field
-from typing import Generic, Literal, TypeVar
+from pydantic import (
+    BaseModel,
+    Field,
+    TypeAdapter,
+    create_model,
+    field_validator,
+    model_validator,
+)
+from typing import Generic, Literal, TypeVar, get_args, get_origin
 
 T = TypeVar("T")  # Datasource data type
 A = TypeVar("A")  # Datasource aggregation type
@@ -38,35 +46,190 @@ def get_list_of_aggregations(aggregation_class):
     return sorted(aggregation_class.schema()["properties"].keys())
 
 
+@functools.cache
+def get_projected_class(data_class, field_names: tuple[str, ...] | None):
+    # Validate projected records against their subset of the data class.
+    if field_names is None:
+        return data_class
+    return create_model(
+        f"{data_class.__name__}Projection",
+        **{name: (data_class.model_fields[name].annotation,
+                  data_class.model_fields[name].get_default())
+           for name in field_names},
+    )
+
+
+@functools.cache
+def get_field_normalizers(data_class):
+    # Fields whose JSON form differs from the value stored in Elasticsearch,
+    # e.g. dates, which the fast path still has to round trip through Pydantic.
+    normalizers = {}
+    for name, field in data_class.model_fields.items():
+        if datetime.datetime in (field.annotation, *get_args(field.annotation)):
+            adapter = TypeAdapter(field.annotation)
+            normalizers[name] = functools.partial(
+                lambda a, value: a.dump_python(a.validate_python(value), mode="json"),
+                adapter)
+    return normalizers
+
+
+@functools.cache
+def get_optional_fields(data_class):
+    # Fields missing from some documents, returned as null.
+    return tuple(name for name, field in data_class.model_fields.items()
+                 if not field.is_required())
+
+
+def get_partial_class(data_class):
+    # Response model accepting any projection of the data class.
+    return create_model(
+        f"Partial{data_class.__name__}",
+        **{name: (field.annotation | None, None)
+           for name, field in data_class.model_fields.items()},
+    )
+
+
 # Generic Elastic response classes.
 
 
 class ElasticResponse(BaseModel, Generic[T, A]):
-    total: int
+    total: int | None
+    total_relation: Literal["eq", "gte"] | None = None
     start: int
     size: int
     results: list[T]
+    aggregations: A | None
+    next_cursor: str | None = None
+
+
+class ElasticAggregationsResponse(BaseModel, Generic[A]):
+    total: int | None
+    total_relation: Literal["eq", "gte"] | None = None
     aggregations: A
 
 
+class ElasticCountResponse(BaseModel):
+    count: int
+
+
 class ElasticDetailsResponse(BaseModel, Generic[T]):
     results: list[T]
 
 
+class ElasticFacetResponse(BaseModel):
+    field: str
+    buckets: list[AggregationBucket]
+    after: str | None = Field(
+        None, description="Pass as 'after' to get the next page, null on the "
+                          "last page")
+
+
+class Suggestion(BaseModel):
+    field: str
+    text: str
+
+
+class ElasticSuggestResponse(BaseModel):
+    results: list[Suggestion]
+
+
+class GeoCluster(BaseModel):
+    key: str = Field(description="Geotile as 'zoom/x/y'")
+    count: int
+    lat: float = Field(description="Centroid latitude of the cluster")
+    lon: float = Field(description="Centroid longitude of the cluster")
+
+
+class ElasticGeoResponse(BaseModel):
+    total: int
+    precision: int
+    clusters: list[GeoCluster]
+
+
+class BatchRequest(BaseModel):
+    ids: list[str] = Field(min_length=1, max_length=1000,
+                           description="Record IDs to resolve")
+
+
 # Base Elastic query class.
 
-class SearchParams(BaseModel):
+class QueryParams(BaseModel):
     model_config = {
         "populate_by_name": True,
         "extra": "forbid",
     }
     # Basic query parameters.
     q: str | None = Field(None, description="Search query string")
+    match: Literal["fuzzy", "exact", "prefix"] = Field(
+        "fuzzy", description="How 'q' is matched, 'exact' and 'prefix' skip "
+                             "fuzzy expansion and are much faster")
+
+
+class SearchParams(QueryParams):
+    # Paging and counting of hits.
     start: int = Field(0, description="Starting point of the results")
     size: int = Field(10, gt=0, description="Number of results per page")
-    # No sorting by default, child classes can override this.
-    sort_field: str | None = None
-    sort_order: Literal["desc", "asc"] = "asc"
+    cursor: str | None = Field(
+        None,
+        description="Opaque cursor for deep pagination, use '*' to start from "
+                    "'start' and then pass the returned 'next_cursor'",
+    )
+    aggregations: bool = Field(
+        True, description="Include facet aggregations, disable when only "
+                          "paging through hits")
+    track_total_hits: Literal["exact", "capped", "off"] = Field(
+        "capped", description="How matches are counted, 'capped' stops counting "
+                              "at TRACK_TOTAL_HITS_CAP and 'off' returns a null "
+                              "total, use the count endpoint for exact totals")
+
+
+class GeoParams(BaseModel):
+    bbox: list[float] | None = Field(
+        None, description="Bounding box as 'west,south,east,north'")
+    polygon: list[float] | None = Field(
+        None, description="Polygon as 'lon,lat,lon,lat,...' with at least three "
+                          "points")
+
+    @field_validator("bbox", "polygon", mode="before")
+    @classmethod
+    def split_coordinates(cls, value):
+        # Accept repeated and comma separated values.
+        if value is None:
+            return None
+        if isinstance(value, str):
+            value = [value]
+        return [item for items in value for item in str(items).split(",")
+                if item.strip()]
+
+    @model_validator(mode="after")
+    def validate_coordinates(self):
+        if self.bbox is not None:
+            if len(self.bbox) != 4:
+                raise ValueError("bbox needs exactly four coordinates")
+            west, south, east, north = self.bbox
+            if not (-90 <= south <= north <= 90 and -180 <= west <= 180
+                    and -180 <= east <= 180):
+                raise ValueError("bbox is out of range")
+        if self.polygon is not None:
+            if len(self.polygon) < 6 or len(self.polygon) % 2:
+                raise ValueError("polygon needs at least three lon,lat pairs")
+            if not all(-180 <= lon <= 180 and -90 <= lat <= 90
+                       for lon, lat in zip(self.polygon[::2], self.polygon[1::2])):
+                raise ValueError("polygon is out of range")
+        return self
+
+
+class ChangesParams(BaseModel):
+    updated_since: datetime.datetime | None = Field(
+        None, description="Only records updated at or after this time")
+
+
+class SuggestParams(BaseModel):
+    model_config = {
+        "extra": "forbid",
+    }
+    q: str = Field(min_length=1, description="Prefix to complete")
+    size: int = Field(10, gt=0, le=50, description="Number of suggestions")
 
 
 # Datasource definition.
@@ -74,30 +237,122 @@ class SearchParams(BaseModel):
 
 class FieldDefinition:
     def __init__(self, name: str, type: type | types.UnionType,
-                 filterable: bool = False):
+                 filterable: bool = False, search_boost: float | None = None,
+                 suggest: bool = False, facet_size: int = 100):
         self.name = name
         self.type = type
         self.filterable = filterable
+        # Buckets of a filterable field returned with search results, the rest
+        # are paged through the facets endpoint.
+        self.facet_size = facet_size
+        # Free text search only runs over fields with a boost.
+        self.search_boost = search_boost
+        # Suggest fields are completed from their "suggest" completion sub-field.
+        self.suggest = suggest
+
+    @property
+    def sortable(self):
+        # Multi-valued fields have no single value to sort on.
+        return not any(get_origin(type_) is list
+                       for type_ in (self.type, *get_args(self.type)))
+
+    @property
+    def search_fields(self):
+        # Lists of objects are searched through all of their sub-fields. The
+        # analyzed "text" sub-field matches words within values, the exact
+        # field ranks whole value matches higher.
+        path = self.name if self.sortable else f"{self.name}.*"
+        return [f"{path}^{self.search_boost:g}",
+                f"{path}.text^{self.search_boost:g}"]
+
+
+class GeoPointDefinition:
+    def __init__(self, name: str, lat: str, lon: str):
+        # Geo point field, indexed from the `lat` and `lon` fields of every
+        # record, see ingest.py.
+        self.name = name
+        self.lat = lat
+        self.lon = lon
 
 
 class DataSource:
     def __init__(
             self,
             name: str,
+            index_name: str,
             fields: list[FieldDefinition],
             default_sort_field: str,
             default_sort_order: Literal["desc", "asc"],
+            field_presets: dict[str, list[str]] | None = None,
+            trusted: bool = False,
+            geo_point: GeoPointDefinition | None = None,
+            updated_field: str | None = None,
     ):
         self.name = name
+        self.index_name = index_name
         self.fields = fields
         self.default_sort_field = default_sort_field
         self.default_sort_order = default_sort_order
+        # Named field projections, "full" always returns every field.
+        self.field_presets = {"full": [field.name for field in fields],
+                              **(field_presets or {})}
+        # Trusted sources skip response validation and are encoded directly.
+        self.trusted = trusted
+        # Sources with a geo point support geo filters and clustering.
+        self.geo_point = geo_point
+        # Date field with the last change of every record, for incremental sync.
+        self.updated_field = updated_field
+
+    def resolve_fields(self, value):
+        # Accept repeated and comma separated values, expanding presets.
+        if value is None:
+            return None
+        if isinstance(value, str):
+            value = [value]
+        field_names = [field.name for field in self.fields]
+        requested = set()
+        for item in value:
+            for name in item.split(","):
+                name = name.strip()
+                if name in self.field_presets:
+                    requested.update(self.field_presets[name])
+                elif name in field_names:
+                    requested.add(name)
+                elif name:
+                    raise ValueError(f"Unknown field or preset '{name}'")
+        # No projection needed when every field is requested.
+        if not requested or len(requested) == len(field_names):
+            return None
+        return [name for name in field_names if name in requested]
 
     def generate_classes(self):
         fields = {field.name: (field.type, field.filterable) for field in self.fields}
+        sort_fields = tuple(field.name for field in self.fields if field.sortable)
+        resolve_fields = self.resolve_fields
+
+        class ProjectionParams(BaseModel):
+            model_config = {
+                "extra": "forbid",
+            }
+            fields: list[str] | None = Field(
+                None,
+                description="Fields to return, as field names or presets "
+                            f"({', '.join(self.field_presets)})",
+            )
+
+            @field_validator("fields", mode="before")
+            @classmethod
+            def validate_fields(cls, value):
+                return resolve_fields(value)
 
         class Data(BaseModel):
             __annotations__ = {name: type for name, (type, _) in fields.items()}
+            # Nullable fields may be missing from documents indexed before
+            # they were added.
+            locals().update(
+                {name: None for name, (type_, _) in fields.items()
+                 if type(None) in get_args(type_)}
+            )
 
         class AggregationResponse(BaseModel):
             __annotations__ = {
@@ -106,7 +361,15 @@ class DataSource:
                 if filterable
             }
 
-        class SearchParamsExtended(SearchParams):
+        # Geo filters are only offered for sources with a geo point.
+        filter_bases = (QueryParams,)
+        if self.geo_point is not None:
+            filter_bases += (GeoParams,)
+        if self.updated_field is not None:
+            filter_bases += (ChangesParams,)
+
+        # Everything selecting records, shared by all query endpoints.
+        class FilterParams(*filter_bases):
             # Define filterable fields with default values
             locals().update(
                 {
@@ -120,34 +383,105 @@ class DataSource:
                 for name, (type_, filterable) in fields.items()
                 if filterable
             }
+
+        class SortParams(BaseModel):
             # Define default sort field and order.
-            sort_field: str | None = Field(
+            sort_field: Literal[sort_fields] | None = Field(
                 self.default_sort_field, description="Sort field"
             )
             sort_order: Literal["desc", "asc"] = Field(
                 self.default_sort_order, description="Sort order"
             )
 
-        return Data, AggregationResponse, SearchParamsExtended
+        class SearchParamsExtended(FilterParams, SearchParams, SortParams,
+                                   ProjectionParams):
+            pass
+
+        class ExportParams(FilterParams, SortParams, ProjectionParams):
+            format: Literal["ndjson", "csv", "parquet"] = Field(
+                "ndjson", description="Export format")
+
+        class GeoClusterParams(FilterParams):
+            zoom: int = Field(0, ge=0, le=29, description="Map zoom level")
+
+        class FacetParams(FilterParams):
+            after: str | None = Field(
+                None, description="Bucket key to continue after, from the "
+                                  "previous page")
+            prefix: str | None = Field(
+                None, min_length=1,
+                description="Only buckets starting with this prefix, ignoring "
+                            "case")
+            size: int | None = Field(
+                None, gt=0, le=1000,
+                description="Buckets per page, defaults to the facet size of "
+                            "the field")
+
+        return (Data, AggregationResponse, SearchParamsExtended, ProjectionParams,
+                ExportParams, GeoClusterParams, FacetParams, FilterParams)
+
+    def compile(self):
+        # Generate the classes and precompute the query parts shared by every
+        # request, so per-request work is reduced to filling in params.
+        (self.data_class, self.aggregation_class, self.search_params_class,
+         self.projection_params_class,
+         self.export_params_class,
+         self.geo_params_class,
+         self.facet_params_class,
+         self.filter_params_class) = self.generate_classes()
+        self.partial_data_class = get_partial_class(self.data_class)
+        self.aggregation_fields = get_list_of_aggregations(self.aggregation_class)
+        self.facet_sizes = {field.name: field.facet_size for field in self.fields
+                            if field.filterable}
+        self.aggregations = {
+            field: {"terms": {"field": field, "size": self.facet_sizes[field]}}
+            for field in self.aggregation_fields
+        }
+        self.source_fields = list(self.data_class.model_fields)
+        self.search_fields = [name for field in self.fields
+                              if field.search_boost is not None
+                              for name in field.search_fields] or ["*"]
+        self.suggest_fields = [field.name for field in self.fields if field.suggest]
+
+
+# Registry of data sources, each mounted under "/<index_name>".
+data_sources: dict[str, DataSource] = {}
+
+
+def register_data_source(data_source: DataSource) -> DataSource:
+    data_source.compile()
+    data_sources[data_source.index_name] = data_source
+    return data_source
 
 
 # TREC.
-trec = DataSource(
+trec = register_data_source(DataSource(
     name="TREC",
+    index_name="data_portal",
     fields=[
-        FieldDefinition(name="altitude", type=str, filterable=True),
+        FieldDefinition(name="altitude", type=str, filterable=True,
+                        search_boost=1),
         FieldDefinition(name="collection_date", type=datetime.datetime | None),
-        FieldDefinition(name="depth", type=str, filterable=True),
-        FieldDefinition(name="location", type=str, filterable=True),
+        FieldDefinition(name="depth", type=str, filterable=True, search_boost=1),
+        FieldDefinition(name="location", type=str, filterable=True,
+                        search_boost=2, suggest=True, facet_size=20),
         FieldDefinition(name="lat", type=float | None),
         FieldDefinition(name="lon", type=float | None),
-        FieldDefinition(name="organism", type=str, filterable=True),
-        FieldDefinition(name="biosampleId", type=str),
-        FieldDefinition(name="customFields", type=list[CustomField] | None),
+        FieldDefinition(name="organism", type=str, filterable=True,
+                        search_boost=3, suggest=True, facet_size=20),
+        FieldDefinition(name="biosampleId", type=str, search_boost=5),
+        FieldDefinition(name="customFields", type=list[CustomField] | None,
+                        search_boost=1),
         FieldDefinition(name="relationships",
                         type=list[BioSamplesRelationships] | None),
+        FieldDefinition(name="last_updated", type=datetime.datetime | None),
     ],
     default_sort_field="collection_date",
     default_sort_order="desc",
-)
-TRECData, TRECAggregationResponse, TRECSearchParams = trec.generate_classes()
+    field_presets={
+        "summary": ["altitude", "depth", "location", "organism", "biosampleId"],
+    },
+    trusted=True,
+    geo_point=GeoPointDefinition(name="coordinates", lat="lat", lon="lon"),
+    updated_field="last_updated",
+))
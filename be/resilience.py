@@ -0,0 +1,128 @@
+import asyncio
+import random
+import time
+
+from elasticsearch import ApiError, ConnectionError as TransportConnectionError
+
+# Statuses worth retrying: overloaded or temporarily unavailable cluster.
+RETRYABLE_STATUSES = {429, 502, 503, 504}
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+def is_transient(error):
+    if isinstance(error, (TransportConnectionError, asyncio.TimeoutError)):
+        return True
+    return isinstance(error, ApiError) and error.meta.status in RETRYABLE_STATUSES
+
+
+class CircuitBreaker:
+    """Fail fast after consecutive transient failures.
+
+    Once `failure_threshold` failures happen in a row the breaker opens and
+    rejects calls for `reset_timeout` seconds, then lets a single probe call
+    through to decide whether to close again.
+    """
+
+    def __init__(self, failure_threshold: int, reset_timeout: float):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.trips = 0
+        self.opened_at = None
+        self.probing = False
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return "half-open"
+        return "open"
+
+    def before_call(self) -> bool:
+        # Whether the call is the probe of a half-open breaker.
+        state = self.state
+        if state == "open" or (state == "half-open" and self.probing):
+            raise CircuitOpenError("Elasticsearch circuit breaker is open")
+        if state == "half-open":
+            self.probing = True
+            return True
+        return False
+
+    def release_probe(self):
+        # A probe ending without a result, e.g. when cancelled, lets the next
+        # call probe instead.
+        self.probing = False
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+
+    def record_failure(self):
+        self.failures += 1
+        if self.probing or self.failures >= self.failure_threshold:
+            if self.state == "closed":
+                self.trips += 1
+            self.opened_at = time.monotonic()
+            self.probing = False
+
+
+class Resilience:
+    """Run idempotent Elasticsearch reads with a timeout budget, jittered
+    retries and a circuit breaker."""
+
+    def __init__(self, breaker: CircuitBreaker, retries: int, backoff: float,
+                 backoff_max: float, timeout_budget: float):
+        self.breaker = breaker
+        self.retries = retries
+        self.backoff = backoff
+        self.backoff_max = backoff_max
+        self.timeout_budget = timeout_budget
+        self.retried = 0
+
+    async def call(self, function):
+        # `function` creates a new coroutine for every attempt.
+        probe = self.breaker.before_call()
+        try:
+            return await self._call(function)
+        finally:
+            if probe:
+                self.breaker.release_probe()
+
+    async def _call(self, function):
+        deadline = time.monotonic() + self.timeout_budget
+        attempt = 0
+        while True:
+            try:
+                result = await asyncio.wait_for(function(),
+                                                deadline - time.monotonic())
+            except Exception as e:
+                if not is_transient(e):
+                    # The cluster answered, e.g. with a 404.
+                    self.breaker.record_success()
+                    raise
+                self.breaker.record_failure()
+                attempt += 1
+                # Full jitter exponential backoff, within the timeout budget.
+                delay = random.uniform(
+                    0, min(self.backoff_max, self.backoff * 2 ** attempt))
+                if (attempt > self.retries or self.breaker.state != "closed"
+                        or time.monotonic() + delay >= deadline):
+                    raise
+                self.retried += 1
+                await asyncio.sleep(delay)
+            else:
+                self.breaker.record_success()
+                return result
+
+    def stats(self) -> dict:
+        return {
+            "breaker_state": self.breaker.state,
+            "breaker_open": int(self.breaker.state == "open"),
+            "breaker_trips": self.breaker.trips,
+            "retries": self.retried,
+        }
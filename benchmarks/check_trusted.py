@@ -0,0 +1,80 @@
+"""Check that the trusted fast path returns the same JSON as validation.
+
+Runs a set of searches, details and batch lookups against the synthetic
+corpus with `trusted` on and off and exits with status 1 on any difference.
+"""
+import asyncio
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "be"))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+os.environ["CACHE_MAX_BYTES"] = "0"
+
+import httpx  # noqa: E402
+import main  # noqa: E402
+from fake_es import FakeAsyncElasticsearch, generate_corpus  # noqa: E402
+
+QUERIES = [
+    {},
+    {"size": 50, "start": 100},
+    {"fields": "summary"},
+    {"fields": "biosampleId,collection_date,lat"},
+    {"aggregations": "false"},
+    {"q": "metagenome", "organism": "marine metagenome"},
+    {"sort_field": "biosampleId", "sort_order": "asc"},
+    {"cursor": "*", "size": 5},
+    {"track_total_hits": "exact"},
+    {"track_total_hits": "off", "start": 20},
+]
+
+
+def lookup_requests(docs):
+    # Details of a found and a missing record, and batches mixing both.
+    found, other = docs[0]["biosampleId"], docs[1]["biosampleId"]
+    ids = {"ids": [found, "MISSING", other]}
+    return [
+        ("GET", f"/data_portal/{found}", {}, None),
+        ("GET", f"/data_portal/{found}", {"fields": "summary"}, None),
+        ("GET", "/data_portal/MISSING", {}, None),
+        ("POST", "/data_portal/batch", {}, ids),
+        ("POST", "/data_portal/batch", {"fields": "summary"}, ids),
+        ("POST", "/data_portal/batch", {}, {"ids": ["MISSING"]}),
+    ]
+
+
+async def fetch_all(client, requests, trusted):
+    main.data_sources["data_portal"].trusted = trusted
+    responses = []
+    for method, path, params, body in requests:
+        response = await client.request(method, path, params=params, json=body)
+        responses.append((response.status_code, response.json()))
+    return responses
+
+
+async def check():
+    docs = generate_corpus(2000)
+    # A record without its optional fields, as indexed before they existed.
+    for name in ("lat", "lon", "last_updated"):
+        docs[1].pop(name, None)
+    main.app.state.es_client = FakeAsyncElasticsearch(docs, latency=0)
+    requests = ([("GET", "/data_portal", params, None) for params in QUERIES]
+                + lookup_requests(docs))
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport,
+                                 base_url="http://benchmark") as client:
+        trusted = await fetch_all(client, requests, True)
+        validated = await fetch_all(client, requests, False)
+    failed = False
+    for request, fast, slow in zip(requests, trusted, validated):
+        if fast != slow:
+            failed = True
+            print(f"MISMATCH {request}")
+    print("trusted and validated responses differ" if failed
+          else f"{len(requests)} requests match")
+    return failed
+
+
+if __name__ == "__main__":
+    sys.exit(1 if asyncio.run(check()) else 0)
@@ -0,0 +1,358 @@
+"""In-process stand-in for AsyncElasticsearch serving a synthetic corpus.
+
+It implements the subset of the client API the backend uses, with
+Elasticsearch-shaped responses and a simple latency model: a fixed per-call
+latency plus a per-document cost for every hit skipped with `from`, which is
+what makes deep offset pages expensive on a real cluster.
+"""
+import asyncio
+import bisect
+import copy
+import math
+import random
+from collections import Counter
+
+from elastic_transport import ApiResponseMeta
+from elasticsearch import NotFoundError
+
+ORGANISMS = ["marine metagenome", "soil metagenome", "seawater metagenome",
+             "sediment metagenome", "freshwater metagenome", "plankton"]
+DEPTHS = ["0-30 m", "30-100 m", "100-500 m", "0 m", "5 m", "not applicable"]
+ALTITUDES = ["0 m", "10 m", "100 m", "not applicable"]
+LOCATIONS = ["France", "Spain", "Italy", "Greece", "Portugal", "Croatia",
+             "Germany", "Norway", "Sweden", "Ireland", "United Kingdom"]
+FILTER_FIELDS = ["altitude", "depth", "location", "organism"]
+TEXT_FIELDS = ["organism", "location", "depth", "altitude", "biosampleId"]
+
+
+def generate_corpus(size, seed=42):
+    # Long tail of organism and location values, so large corpora have more
+    # than 100 buckets per facet like the real index.
+    rng = random.Random(seed)
+    organisms = ORGANISMS + [f"{rng.choice(ORGANISMS).split()[0]} sp. {i}"
+                             for i in range(max(0, size // 200))]
+    locations = LOCATIONS + [f"{rng.choice(LOCATIONS)}: site {i}"
+                             for i in range(max(0, size // 500))]
+    docs = []
+    for i in range(size):
+        biosample_id = f"SAMEA{110000000 + i}"
+        relationships = [
+            {"source": biosample_id, "type": "derived from",
+             "target": f"SAMEA{110000000 + rng.randrange(size)}"}
+            for _ in range(rng.choice([0, 0, 1, 2]))
+        ]
+        docs.append({
+            "altitude": rng.choice(ALTITUDES),
+            "collection_date": f"20{rng.randint(15, 24)}-{rng.randint(1, 12):02d}-"
+                               f"{rng.randint(1, 28):02d}",
+            "depth": rng.choice(DEPTHS),
+            "location": rng.choice(locations),
+            "lat": round(rng.uniform(35, 70), 4),
+            "lon": round(rng.uniform(-10, 30), 4),
+            "organism": rng.choice(organisms) if rng.random() < 0.3
+            else rng.choice(ORGANISMS),
+            "biosampleId": biosample_id,
+            "customFields": [
+                {"name": "environment (biome)", "value": "marine biome",
+                 "unit": ""},
+                {"name": "temperature", "value": f"{rng.uniform(2, 25):.1f}",
+                 "unit": "°C"},
+            ],
+            "relationships": relationships,
+            "last_updated": f"2025-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}"
+                            f"T{rng.randint(0, 23):02d}:00:00+00:00",
+        })
+    return docs
+
+
+def geotile(lat, lon, precision):
+    tiles = 2 ** precision
+    x = min(tiles - 1, int((lon + 180) / 360 * tiles))
+    lat_rad = math.radians(max(-85.05112878, min(85.05112878, lat)))
+    y = int((1 - math.asinh(math.tan(lat_rad)) / math.pi) / 2 * tiles)
+    return f"{precision}/{x}/{min(tiles - 1, y)}"
+
+
+def in_bounds(doc, bounds):
+    west, east = bounds["top_left"]["lon"], bounds["bottom_right"]["lon"]
+    lon_ok = (west <= doc["lon"] <= east if west <= east
+              else doc["lon"] >= west or doc["lon"] <= east)
+    return lon_ok and (bounds["bottom_right"]["lat"] <= doc["lat"]
+                       <= bounds["top_left"]["lat"])
+
+
+def in_polygon(doc, ring):
+    # Ray casting over the polygon edges.
+    inside = False
+    for (x1, y1), (x2, y2) in zip(ring, ring[1:]):
+        if (y1 > doc["lat"]) != (y2 > doc["lat"]):
+            if doc["lon"] < (x2 - x1) * (doc["lat"] - y1) / (y2 - y1) + x1:
+                inside = not inside
+    return inside
+
+
+def not_found():
+    meta = ApiResponseMeta(status=404, http_version="1.1", headers={},
+                           duration=0, node=None)
+    return NotFoundError("document not found", meta, {"found": False})
+
+
+class FakeIndices:
+    def __init__(self, client):
+        self.client = client
+
+    async def stats(self, index=None, metric=None, **kwargs):
+        return {"indices": {index: {
+            "uuid": "benchmark",
+            "primaries": {"indexing": {"index_total": len(self.client.docs),
+                                       "delete_total": 0}},
+        }}}
+
+
+class FakeAsyncElasticsearch:
+    def __init__(self, docs, latency=0.002, deep_page_cost=0.000002):
+        self.docs = docs
+        self.latency = latency
+        self.deep_page_cost = deep_page_cost
+        self.indices = FakeIndices(self)
+        self.calls = Counter()
+        self.by_id = {doc["biosampleId"]: i for i, doc in enumerate(docs)}
+        self.postings = {field: {} for field in FILTER_FIELDS}
+        for i, doc in enumerate(docs):
+            for field in FILTER_FIELDS:
+                self.postings[field].setdefault(doc[field], set()).add(i)
+        self.full_counts = {field: Counter({value: len(positions)
+                                            for value, positions in values.items()})
+                            for field, values in self.postings.items()}
+        self.orders = {}
+
+    async def wait(self, skipped=0):
+        seconds = self.latency + self.deep_page_cost * skipped
+        await asyncio.sleep(seconds)
+        return int(seconds * 1000)
+
+    def order(self, sort):
+        # Document positions sorted by the first sort clause, doc order breaks
+        # ties like _shard_doc does.
+        key = next((k for clause in sort for k in clause if k != "_shard_doc"), None)
+        direction = sort[0][key]["order"] if key else "asc"
+        if (key, direction) not in self.orders:
+            positions = list(range(len(self.docs)))
+            if key:
+                positions.sort(key=lambda i: (self.docs[i].get(key) is None,
+                                              self.docs[i].get(key)),
+                               reverse=direction == "desc")
+            ranks = [0] * len(positions)
+            for rank, position in enumerate(positions):
+                ranks[position] = rank
+            self.orders[(key, direction)] = (key, positions, ranks)
+        return self.orders[(key, direction)]
+
+    def matching(self, query):
+        # Positions matching the bool query, None meaning every document.
+        matched = None
+        bool_query = query.get("bool", {}) if query else {}
+        for clause in bool_query.get("filter", []):
+            for field, values in clause.get("terms", {}).items():
+                positions = set().union(*(self.postings.get(field, {}).get(v, set())
+                                          for v in values))
+                matched = positions if matched is None else matched & positions
+            if "geo_bounding_box" in clause:
+                bounds = next(iter(clause["geo_bounding_box"].values()))
+                positions = {i for i in (range(len(self.docs)) if matched is None
+                                         else matched)
+                             if in_bounds(self.docs[i], bounds)}
+                matched = positions
+            if "range" in clause:
+                field, bounds = next(iter(clause["range"].items()))
+                # ISO dates in the same time zone compare as strings.
+                gte = bounds["gte"]
+                positions = {i for i in (range(len(self.docs)) if matched is None
+                                         else matched)
+                             if (self.docs[i].get(field) or "") >= gte}
+                matched = positions
+            if "prefix" in clause:
+                field, prefix = next(iter(clause["prefix"].items()))
+                text = prefix["value"].lower()
+                positions = set().union(*(
+                    value_positions for value, value_positions
+                    in self.postings[field].items() if value.lower().startswith(text)))
+                matched = positions if matched is None else matched & positions
+            if "geo_shape" in clause:
+                shape = next(iter(clause["geo_shape"].values()))["shape"]
+                positions = {i for i in (range(len(self.docs)) if matched is None
+                                         else matched)
+                             if in_polygon(self.docs[i], shape["coordinates"][0])}
+                matched = positions
+        multi_match = bool_query.get("must", {}).get("multi_match")
+        if multi_match:
+            text = multi_match["query"].lower()
+            positions = set()
+            for field in FILTER_FIELDS:
+                for value, value_positions in self.postings[field].items():
+                    if text in value.lower():
+                        positions |= value_positions
+            if text.upper() in self.by_id:
+                positions.add(self.by_id[text.upper()])
+            matched = positions if matched is None else matched & positions
+        return matched
+
+    def project(self, doc, includes):
+        if includes is False:
+            return None
+        if includes:
+            return copy.deepcopy({k: v for k, v in doc.items() if k in includes})
+        return copy.deepcopy(doc)
+
+    async def search(self, index=None, body=None, **kwargs):
+        self.calls["search"] += 1
+        body = body or kwargs
+        if "suggest" in body:
+            return await self.suggest(body["suggest"])
+        size = body.get("size", 10)
+        start = body.get("from", 0)
+        matched = self.matching(body.get("query"))
+        key, positions, ranks = self.order(body.get("sort") or [])
+        if matched is not None:
+            positions = sorted(matched, key=ranks.__getitem__)
+        if body.get("search_after") is not None:
+            after_rank = body["search_after"][-1]
+            start = bisect.bisect_right([ranks[p] for p in positions], after_rank)
+        took = await self.wait(skipped=body.get("from", 0))
+        page = positions[start:start + size]
+        response = {
+            "took": took,
+            "timed_out": False,
+            "hits": {
+                "hits": [{
+                    "_index": index or "data_portal",
+                    "_id": self.docs[p]["biosampleId"],
+                    "_source": self.project(self.docs[p], body.get("_source")),
+                    "sort": [self.docs[p].get(key), ranks[p]] if key else [ranks[p]],
+                } for p in page],
+            },
+        }
+        track_total_hits = body.get("track_total_hits", 10000)
+        if track_total_hits is not False:
+            cap = len(positions) if track_total_hits is True else track_total_hits
+            response["hits"]["total"] = {
+                "value": min(len(positions), cap),
+                "relation": "eq" if len(positions) <= cap else "gte"}
+        if "pit" in body:
+            response["pit_id"] = body["pit"]["id"]
+        if body.get("aggs"):
+            response["aggregations"] = self.aggregations(body["aggs"], matched)
+        return response
+
+    def aggregations(self, aggs, matched):
+        results = {}
+        for name, agg in aggs.items():
+            if "geotile_grid" in agg:
+                results[name] = self.geotile_grid(agg["geotile_grid"], matched)
+                continue
+            if "composite" in agg:
+                results[name] = self.composite(agg["composite"], matched)
+                continue
+            field = agg["terms"]["field"]
+            if matched is None:
+                counts = self.full_counts[field]
+            else:
+                counts = Counter(self.docs[p][field] for p in matched)
+            top = counts.most_common(agg["terms"].get("size", 10))
+            results[name] = {
+                "doc_count_error_upper_bound": 0,
+                "sum_other_doc_count": sum(counts.values()) - sum(c for _, c in top),
+                "buckets": [{"key": k, "doc_count": c} for k, c in top],
+            }
+        return results
+
+    def composite(self, composite, matched):
+        (name, source), = composite["sources"][0].items()
+        field = source["terms"]["field"]
+        if matched is None:
+            counts = self.full_counts[field]
+        else:
+            counts = Counter(self.docs[p][field] for p in matched)
+        keys = sorted(counts)
+        if composite.get("after"):
+            keys = keys[bisect.bisect_right(keys, composite["after"][name]):]
+        page = keys[:composite["size"]]
+        result = {"buckets": [{"key": {name: key}, "doc_count": counts[key]}
+                              for key in page]}
+        if page:
+            result["after_key"] = {name: page[-1]}
+        return result
+
+    def geotile_grid(self, grid, matched):
+        cells = {}
+        for p in range(len(self.docs)) if matched is None else matched:
+            doc = self.docs[p]
+            if "bounds" in grid and not in_bounds(doc, grid["bounds"]):
+                continue
+            cell = cells.setdefault(geotile(doc["lat"], doc["lon"],
+                                            grid["precision"]), [0, 0.0, 0.0])
+            cell[0] += 1
+            cell[1] += doc["lat"]
+            cell[2] += doc["lon"]
+        top = sorted(cells.items(), key=lambda item: -item[1][0])[:grid["size"]]
+        return {"buckets": [
+            {"key": key, "doc_count": count,
+             "centroid": {"location": {"lat": lat / count, "lon": lon / count},
+                          "count": count}}
+            for key, (count, lat, lon) in top
+        ]}
+
+    async def suggest(self, suggest):
+        took = await self.wait()
+        results = {}
+        for name, suggester in suggest.items():
+            field = suggester["completion"]["field"].split(".")[0]
+            prefix = suggester["prefix"].lower()
+            options = [{"text": value, "_score": float(len(positions))}
+                       for value, positions in self.postings[field].items()
+                       if value.lower().startswith(prefix)]
+            options.sort(key=lambda option: -option["_score"])
+            results[name] = [{"text": suggester["prefix"], "offset": 0,
+                              "length": len(prefix),
+                              "options": options[:suggester["completion"]["size"]]}]
+        return {"took": took, "hits": {"total": {"value": 0}, "hits": []},
+                "suggest": results}
+
+    async def count(self, index=None, query=None, **kwargs):
+        self.calls["count"] += 1
+        matched = self.matching(query)
+        await self.wait()
+        return {"count": len(self.docs) if matched is None else len(matched),
+                "_shards": {"total": 1, "successful": 1, "skipped": 0,
+                            "failed": 0}}
+
+    async def get(self, index, id, source_includes=None, **kwargs):
+        self.calls["get"] += 1
+        await self.wait()
+        if id not in self.by_id:
+            raise not_found()
+        doc = self.docs[self.by_id[id]]
+        return {"_index": index, "_id": id, "found": True,
+                "_source": self.project(doc, source_includes)}
+
+    async def mget(self, index, ids, source_includes=None, **kwargs):
+        self.calls["mget"] += 1
+        await self.wait()
+        return {"docs": [
+            {"_index": index, "_id": i, "found": True,
+             "_source": self.project(self.docs[self.by_id[i]], source_includes)}
+            if i in self.by_id else {"_index": index, "_id": i, "found": False}
+            for i in ids
+        ]}
+
+    async def open_point_in_time(self, index, keep_alive, **kwargs):
+        self.calls["open_point_in_time"] += 1
+        await self.wait()
+        return {"id": f"pit-{index}"}
+
+    async def close_point_in_time(self, id, **kwargs):
+        self.calls["close_point_in_time"] += 1
+        return {"succeeded": True, "num_freed": 1}
+
+    async def close(self):
+        pass
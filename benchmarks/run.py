@@ -0,0 +1,373 @@
+"""Load and latency benchmarks for the backend and the Dash callbacks.
+
+The FastAPI app runs in process against `FakeAsyncElasticsearch`, so numbers
+measure our own query building, validation and serialization plus a modelled
+Elasticsearch latency, and are comparable across commits on the same machine:
+
+    python benchmarks/run.py --output before.json
+    git checkout my-branch
+    python benchmarks/run.py --output after.json --compare before.json
+"""
+import argparse
+import asyncio
+import datetime
+import gc
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "be"))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_es import FakeAsyncElasticsearch, generate_corpus  # noqa: E402
+
+BACKEND_SCENARIOS = ["search", "search_summary", "filtered_search",
+                     "deep_offset", "deep_cursor", "details", "batch", "facets",
+                     "facet_page", "count", "geo_clusters"]
+FRONTEND_SCENARIOS = ["fe_data_facets", "fe_data_page", "fe_details",
+                      "fe_build_table",
+                      "fe_build_table_selection", "fe_build_map",
+                      "fe_map_layout"]
+
+
+def percentile(sorted_values, p):
+    # Nearest rank percentile.
+    if not sorted_values:
+        return None
+    rank = max(0, min(len(sorted_values) - 1,
+                      round(p / 100 * len(sorted_values) + 0.5) - 1))
+    return sorted_values[rank]
+
+
+def summarize(scenario, corpus_size, latencies, wall, errors, concurrency):
+    latencies = sorted(latencies)
+    return {
+        "scenario": scenario,
+        "corpus_size": corpus_size,
+        "requests": len(latencies),
+        "concurrency": concurrency,
+        "errors": errors,
+        "throughput": round(len(latencies) / wall, 1) if wall else None,
+        "p50_ms": round(percentile(latencies, 50) * 1000, 2),
+        "p95_ms": round(percentile(latencies, 95) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 2),
+    }
+
+
+def git_revision():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], cwd=ROOT,
+                                capture_output=True, text=True).stdout.strip()
+        dirty = subprocess.run(["git", "status", "--porcelain", "be", "fe"],
+                               cwd=ROOT, capture_output=True, text=True).stdout
+        return commit + ("-dirty" if dirty.strip() else "")
+    except OSError:
+        return None
+
+
+# Backend scenarios, each returning (method, path, query params, json body).
+
+def deep_start(fake):
+    # Elasticsearch refuses from + size beyond index.max_result_window.
+    return min(len(fake.docs), 10000) - 20
+
+
+def backend_request(scenario, rng, fake, main):
+    docs = fake.docs
+    if scenario == "search":
+        return "GET", "/data_portal", {"start": rng.randrange(0, 200, 20),
+                                       "size": 20}, None
+    if scenario == "search_summary":
+        return "GET", "/data_portal", {"start": rng.randrange(0, 200, 20),
+                                       "size": 20, "fields": "summary",
+                                       "aggregations": "false"}, None
+    if scenario == "filtered_search":
+        doc = rng.choice(docs)
+        return "GET", "/data_portal", {"organism": doc["organism"],
+                                       "depth": doc["depth"], "size": 20}, None
+    if scenario == "deep_offset":
+        return "GET", "/data_portal", {"start": deep_start(fake),
+                                       "size": 20}, None
+    if scenario == "deep_cursor":
+        # Continue a cursor from the same depth as deep_offset.
+        _, positions, ranks = fake.order(
+            [{"collection_date": {"order": "desc"}}])
+        start = deep_start(fake)
+        last = positions[start - 1]
+        cursor = main.encode_cursor(
+            "pit-data_portal", [docs[last]["collection_date"], ranks[last]], start)
+        return "GET", "/data_portal", {"cursor": cursor, "size": 20}, None
+    if scenario == "details":
+        return "GET", f"/data_portal/{rng.choice(docs)['biosampleId']}", {}, None
+    if scenario == "batch":
+        ids = [doc["biosampleId"] for doc in rng.sample(docs, min(50, len(docs)))]
+        return "POST", "/data_portal/batch", {"fields": "summary"}, {"ids": ids}
+    if scenario == "facets":
+        doc = rng.choice(docs)
+        return "GET", "/data_portal/aggregations", {
+            "q": rng.choice(["metagenome", "marine", "sp."]),
+            "location": doc["location"]}, None
+    if scenario == "count":
+        doc = rng.choice(docs)
+        return "GET", "/data_portal/count", {
+            "q": rng.choice(["metagenome", "marine", "sp."]),
+            "location": doc["location"]}, None
+    if scenario == "facet_page":
+        # Typing into the organism filter, with and without another filter.
+        doc = rng.choice(docs)
+        params = {"prefix": doc["organism"][:rng.randint(1, 3)]}
+        if rng.random() < 0.5:
+            params["depth"] = doc["depth"]
+        return "GET", "/data_portal/facets/organism", params, None
+    if scenario == "geo_clusters":
+        # A viewport somewhere over Europe at a regional zoom level.
+        west, south = rng.uniform(-10, 20), rng.uniform(35, 60)
+        return "GET", "/data_portal/geo", {
+            "zoom": 5, "bbox": f"{west},{south},{west + 10},{south + 8}"}, None
+    raise ValueError(scenario)
+
+
+async def run_backend_scenario(client, scenario, corpus_size, fake, main, args):
+    rng = random.Random(args.seed)
+    semaphore = asyncio.Semaphore(args.concurrency)
+    latencies = []
+    errors = 0
+
+    async def one(record):
+        nonlocal errors
+        method, path, params, body = backend_request(scenario, rng, fake, main)
+        async with semaphore:
+            started = time.perf_counter()
+            response = await client.request(method, path, params=params,
+                                            json=body)
+            elapsed = time.perf_counter() - started
+        if response.status_code != 200:
+            errors += 1
+        if record:
+            latencies.append(elapsed)
+
+    await asyncio.gather(*(one(False) for _ in range(args.warmup)))
+    gc.collect()
+    started = time.perf_counter()
+    await asyncio.gather(*(one(True) for _ in range(args.requests)))
+    wall = time.perf_counter() - started
+    return summarize(scenario, corpus_size, latencies, wall, errors,
+                     args.concurrency)
+
+
+async def run_backend(args, scenarios):
+    import httpx
+    import main
+
+    results = []
+    for corpus_size in args.sizes:
+        fake = FakeAsyncElasticsearch(
+            generate_corpus(corpus_size, seed=args.seed),
+            latency=args.es_latency_ms / 1000,
+            deep_page_cost=args.deep_page_cost_us / 1_000_000)
+        main.app.state.es_client = fake
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport,
+                                     base_url="http://benchmark") as client:
+            for scenario in scenarios:
+                main.result_cache.invalidate()
+                result = await run_backend_scenario(client, scenario, corpus_size,
+                                                    fake, main, args)
+                results.append(result)
+                print_result(result)
+    return results
+
+
+# Frontend scenarios, the callbacks are called as plain functions.
+
+def run_frontend(args, scenarios):
+    import main
+    from fastapi.testclient import TestClient
+
+    fake = FakeAsyncElasticsearch(generate_corpus(max(args.sizes), seed=args.seed),
+                                  latency=args.es_latency_ms / 1000)
+    main.app.state.es_client = fake
+    client = TestClient(main.app)
+
+    # The pages read their data relative to the working directory, without
+    # polling for new snapshots while measuring.
+    os.environ["MAP_DATA_POLL_SECONDS"] = "0"
+    os.chdir(os.path.join(ROOT, "fe"))
+    sys.path.insert(0, os.path.join(ROOT, "fe"))
+    import app  # noqa: F401 registers the pages
+    from dash._callback_context import context_value
+    from dash._utils import AttributeDict
+    from pages import data_portal, data_portal_details, sampling_map
+
+    def trigger(prop_id, value=None):
+        context_value.set(AttributeDict(triggered_inputs=[
+            {"prop_id": prop_id, "value": value}]))
+
+    # Callbacks reading dash.ctx see a selection change as their trigger.
+    trigger("sampling-map-selection.data")
+
+    # Route the backend calls of the pages to the in-process app, caching
+    # responses only when caching is benchmarked.
+    from api_client import api
+    api.session = client
+    api.base_url = str(client.base_url).rstrip("/")
+    if not args.cache:
+        api.cache_ttl = 0
+        data_portal_details.DETAILS_CACHE_TTL = 0
+
+    rng = random.Random(args.seed)
+    ids = sampling_map.MAP_DATA.current.data["id"].tolist()
+
+    def lasso():
+        # A lasso of about 10 by 8 degrees somewhere over Europe.
+        lon, lat = rng.uniform(-10, 20), rng.uniform(35, 60)
+        return {"lassoPoints": {"map": [
+            [lon, lat], [lon + 10, lat + 1], [lon + 8, lat + 8], [lon - 1, lat + 6]]}}
+
+    def data_page():
+        page = rng.randint(1, 10)
+        trigger("pagination.active_page", page)
+        try:
+            return data_portal.update_hits(
+                rng.choice([None, [rng.choice(organisms)]]), None, None, None,
+                rng.choice([None, "metagenome"]), page)
+        finally:
+            trigger("sampling-map-selection.data")
+
+    def map_page_load():
+        # The page layout, then the initial call of the map callback.
+        context_value.set(AttributeDict(triggered_inputs=[]))
+        try:
+            return sampling_map.layout(), sampling_map.build_map(
+                None, sampling_map.map_level(sampling_map.MAP_INITIAL_ZOOM))
+        finally:
+            trigger("sampling-map-selection.data")
+
+    organisms = sorted({doc["organism"] for doc in fake.docs})[:20]
+    # Samples with relationships, resolved with a batch request.
+    detail_ids = [doc["biosampleId"] for doc in fake.docs
+                  if doc["relationships"]][:100]
+    calls = {
+        # A filter change, refreshing the facets, and a page change.
+        "fe_data_facets": lambda: data_portal.update_facets(
+            rng.choice([None, [rng.choice(organisms)]]), None, None, None,
+            rng.choice([None, "metagenome"]), None, None, None, None),
+        "fe_data_page": data_page,
+        "fe_details": lambda: data_portal_details.build_data_portal_details_page(
+            rng.choice(detail_ids)),
+        "fe_build_table": lambda: sampling_map.build_table(
+            None, None, rng.randrange(100), 10, 3),
+        "fe_build_table_selection": lambda: sampling_map.build_table(
+            lasso(), {"points": [{"hovertext": rng.choice(ids)}]}, 0, 10, 3),
+        # Uncached figure build for a zoom level, and a page load served from
+        # the cached initial figure.
+        "fe_build_map": lambda: (
+            sampling_map.MAP_DATA.current.cache.clear(),
+            sampling_map.build_map({"map.zoom": rng.uniform(0, 14)}, None)),
+        "fe_map_layout": map_page_load,
+    }
+
+    results = []
+    for scenario in scenarios:
+        iterations = (args.map_iterations if scenario == "fe_build_map"
+                      else args.callback_iterations)
+        calls[scenario]()
+        gc.collect()
+        latencies = []
+        started = time.perf_counter()
+        for _ in range(iterations):
+            call_started = time.perf_counter()
+            calls[scenario]()
+            latencies.append(time.perf_counter() - call_started)
+        wall = time.perf_counter() - started
+        result = summarize(scenario, len(ids), latencies, wall, 0, 1)
+        results.append(result)
+        print_result(result)
+    return results
+
+
+# Reporting.
+
+def print_result(result):
+    print(f"{result['scenario']:<26} {result['corpus_size']:>8} "
+          f"{result['throughput'] or 0:>9.1f}/s  p50 {result['p50_ms']:>8.2f} ms  "
+          f"p95 {result['p95_ms']:>8.2f} ms  p99 {result['p99_ms']:>8.2f} ms"
+          + (f"  errors {result['errors']}" if result["errors"] else ""))
+
+
+def compare(results, baseline_path):
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    previous = {(r["scenario"], r["corpus_size"]): r for r in baseline["results"]}
+    print(f"\nCompared with {baseline.get('commit')} (negative latency change "
+          "is faster):")
+    for result in results:
+        old = previous.get((result["scenario"], result["corpus_size"]))
+        if old is None:
+            continue
+        changes = []
+        for key in ("p50_ms", "p95_ms", "p99_ms", "throughput"):
+            if old[key]:
+                changes.append(f"{key} {(result[key] / old[key] - 1) * 100:+6.1f}%")
+        print(f"{result['scenario']:<26} {result['corpus_size']:>8}  "
+              + "  ".join(changes))
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+",
+                        default=[1000, 10000, 100000],
+                        help="synthetic corpus sizes")
+    parser.add_argument("--scenarios", nargs="+",
+                        choices=BACKEND_SCENARIOS + FRONTEND_SCENARIOS,
+                        default=BACKEND_SCENARIOS + FRONTEND_SCENARIOS)
+    parser.add_argument("--requests", type=int, default=300,
+                        help="measured requests per backend scenario")
+    parser.add_argument("--warmup", type=int, default=30)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--callback-iterations", type=int, default=50)
+    parser.add_argument("--map-iterations", type=int, default=3)
+    parser.add_argument("--es-latency-ms", type=float, default=2.0,
+                        help="modelled Elasticsearch latency per call")
+    parser.add_argument("--deep-page-cost-us", type=float, default=2.0,
+                        help="modelled cost per document skipped with from")
+    parser.add_argument("--cache", action="store_true",
+                        help="keep the result cache enabled")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", help="write results as JSON")
+    parser.add_argument("--compare", help="JSON results of a previous run")
+    args = parser.parse_args()
+
+    # Measure the work behind every request unless caching is benchmarked.
+    if not args.cache:
+        os.environ["CACHE_MAX_BYTES"] = "0"
+
+    backend = [s for s in args.scenarios if s in BACKEND_SCENARIOS]
+    frontend = [s for s in args.scenarios if s in FRONTEND_SCENARIOS]
+    results = asyncio.run(run_backend(args, backend)) if backend else []
+    if frontend:
+        results += run_frontend(args, frontend)
+
+    report = {
+        "commit": git_revision(),
+        "date": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "settings": {key: value for key, value in vars(args).items()
+                     if key not in ("output", "compare")},
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,99 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# Backend base URL, the public URL is the one linked in browsers.
+API_URL = os.getenv("TREC_API_URL",
+                    "https://trec-be-868757013548.europe-west2.run.app").rstrip("/")
+API_PUBLIC_URL = os.getenv("TREC_API_PUBLIC_URL", API_URL).rstrip("/")
+API_CONNECT_TIMEOUT = float(os.getenv("TREC_API_CONNECT_TIMEOUT_SECONDS", 3.05))
+API_READ_TIMEOUT = float(os.getenv("TREC_API_READ_TIMEOUT_SECONDS", 15))
+API_POOL_SIZE = int(os.getenv("TREC_API_POOL_SIZE", 10))
+API_CACHE_TTL = float(os.getenv("TREC_API_CACHE_TTL_SECONDS", 30))
+API_CACHE_SIZE = int(os.getenv("TREC_API_CACHE_SIZE", 512))
+
+
+def cache_key(path, params):
+    # Params may hold lists, e.g. repeated filter values.
+    return path, tuple(sorted(
+        (name, tuple(value) if isinstance(value, list) else value)
+        for name, value in (params or {}).items()))
+
+
+class ApiClient:
+    """Backend client shared by all callbacks of a worker.
+
+    Connections are pooled and kept alive, every call is bounded by connect
+    and read timeouts, and JSON responses are cached for `cache_ttl` seconds,
+    then revalidated with their ETag. Cached responses are shared between
+    callers and must not be modified.
+    """
+
+    def __init__(self, base_url: str, connect_timeout: float, read_timeout: float,
+                 pool_size: int, cache_ttl: float, cache_size: int):
+        self.base_url = base_url
+        self.timeout = (connect_timeout, read_timeout)
+        self.cache_ttl = cache_ttl
+        self.cache_size = cache_size
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        # key -> (expires_at, etag, data)
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def url(self, path):
+        return f"{self.base_url}/{path.lstrip('/')}"
+
+    def get(self, path, params=None):
+        key = cache_key(path, params)
+        with self._lock:
+            entry = self._cache.get(key)
+            if entry is not None:
+                self._cache.move_to_end(key)
+        if entry is not None and entry[0] > time.monotonic():
+            return entry[2]
+
+        headers = {"If-None-Match": entry[1]} if entry and entry[1] else {}
+        response = self.session.get(self.url(path), params=params,
+                                    headers=headers, timeout=self.timeout)
+        if response.status_code == 304:
+            data, etag = entry[2], entry[1]
+        else:
+            response.raise_for_status()
+            data, etag = response.json(), response.headers.get("ETag")
+        if self.cache_ttl > 0:
+            with self._lock:
+                self._cache[key] = (time.monotonic() + self.cache_ttl, etag, data)
+                self._cache.move_to_end(key)
+                while len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+        return data
+
+    def post(self, path, json, params=None):
+        # Uncached, for lookups too large for a query string.
+        response = self.session.post(self.url(path), json=json, params=params,
+                                     timeout=self.timeout)
+        response.raise_for_status()
+        return response.json()
+
+    def stream(self, path, params=None, read_timeout=None):
+        # Uncached streaming GET, to be used as a context manager.
+        response = self.session.get(
+            self.url(path), params=params, stream=True,
+            timeout=(self.timeout[0], read_timeout or self.timeout[1]))
+        try:
+            response.raise_for_status()
+        except requests.HTTPError:
+            response.close()
+            raise
+        return response
+
+
+api = ApiClient(API_URL, API_CONNECT_TIMEOUT, API_READ_TIMEOUT, API_POOL_SIZE,
+                API_CACHE_TTL, API_CACHE_SIZE)
@@ -0,0 +1,134 @@
+import json
+import logging
+import os
+import threading
+import time
+
+import pandas as pd
+import pyarrow as pa
+
+from map_index import SampleIndex
+
+logger = logging.getLogger(__name__)
+
+# Snapshots written by refresh_map_data.py, the manifest names the current one.
+MAP_DATA_DIR = os.getenv("MAP_DATA_DIR",
+                         os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                      "pages"))
+MAP_DATA_POLL_SECONDS = float(os.getenv("MAP_DATA_POLL_SECONDS", 60))
+MANIFEST_NAME = "sampling_map.json"
+# Snapshot shipped with the image, used until the first refresh.
+BUNDLED_NAME = "sampling_map.arrow"
+# Columns used by the map pages, links are built per table page.
+MAP_COLUMNS = ["lat", "lon", "id", "organism", "depth", "altitude", "location"]
+# Low cardinality columns, stored dictionary encoded.
+DICTIONARY_COLUMNS = ["organism", "depth", "altitude", "location"]
+
+
+def read_manifest(directory):
+    try:
+        with open(os.path.join(directory, MANIFEST_NAME)) as f:
+            manifest = json.load(f)
+    except FileNotFoundError:
+        return None
+    # Manifests of parquet snapshots predate the Arrow files and are ignored.
+    return manifest if manifest["file"].endswith(".arrow") else None
+
+
+def read_map_data(path, columns=MAP_COLUMNS) -> pd.DataFrame:
+    # Snapshots are uncompressed Arrow IPC files. Memory mapped, the string
+    # columns point into the page cache shared by all workers instead of
+    # being copied into every worker.
+    with pa.memory_map(path) as source:
+        table = pa.ipc.open_file(source).read_all().select(columns)
+    return table.to_pandas(split_blocks=True)
+
+
+def current_source(directory):
+    # Path and version of the current snapshot.
+    manifest = read_manifest(directory)
+    if manifest is None:
+        path = os.path.join(directory, BUNDLED_NAME)
+        stat = os.stat(path)
+        return path, f"{stat.st_mtime_ns}-{stat.st_size}"
+    return os.path.join(directory, manifest["file"]), manifest["version"]
+
+
+class MapSnapshot:
+    """One version of the map data with its index and derived values."""
+
+    def __init__(self, data: pd.DataFrame, version: str):
+        self.data = data
+        self.version = version
+        self.index = SampleIndex(data)
+        # Figures and merged points, dropped together with the snapshot.
+        self.cache = {}
+
+    def cached(self, key, build):
+        value = self.cache.get(key)
+        if value is None:
+            value = self.cache[key] = build()
+        return value
+
+
+class MapDataStore:
+    """Serve the current map snapshot, swapping in new versions in the
+    background without restarting the worker.
+
+    The first snapshot is loaded on first use. New snapshots are loaded,
+    indexed and warmed up by `warm` before they replace the current one, so
+    requests never wait for a reload. Callbacks should read `current` once
+    and keep using that snapshot.
+    """
+
+    def __init__(self, directory: str, poll_seconds: float, warm=None):
+        self.directory = directory
+        self.poll_seconds = poll_seconds
+        self.warm = warm
+        self._current = None
+        self._lock = threading.Lock()
+        self._watcher = None
+
+    @property
+    def current(self) -> MapSnapshot:
+        if self._current is None:
+            with self._lock:
+                if self._current is None:
+                    self._current = self.load()
+        return self._current
+
+    def load(self):
+        path, version = current_source(self.directory)
+        snapshot = MapSnapshot(read_map_data(path), version)
+        if self.warm is not None:
+            self.warm(snapshot)
+        return snapshot
+
+    def refresh(self):
+        # Nothing to swap before the first use.
+        if self._current is None:
+            return False
+        _, version = current_source(self.directory)
+        if version == self._current.version:
+            return False
+        snapshot = self.load()
+        with self._lock:
+            self._current = snapshot
+        logger.info("Map data switched to version %s", snapshot.version)
+        return True
+
+    def start(self):
+        if self.poll_seconds <= 0 or self._watcher is not None:
+            return
+        self._watcher = threading.Thread(target=self._watch, name="map-data",
+                                         daemon=True)
+        self._watcher.start()
+
+    def _watch(self):
+        while True:
+            time.sleep(self.poll_seconds)
+            try:
+                self.refresh()
+            except Exception:
+                # Keep serving the current snapshot, retry on the next poll.
+                logger.exception("Reloading the map data failed")
@@ -0,0 +1,86 @@
+import numpy as np
+import pandas as pd
+
+
+class SampleIndex:
+    """ID and grid index over the coordinates of the map samples.
+
+    Area lookups only visit the samples of grid cells overlapping the area, so
+    their cost follows the size of the area rather than the number of samples.
+    Lookups return row positions in the indexed frame, in frame order.
+    """
+
+    def __init__(self, data: pd.DataFrame, cell_size: float = 0.5):
+        self.cell_size = cell_size
+        self.ids = pd.Index(data["id"])
+        lat = data["lat"].to_numpy(dtype="float64")
+        lon = data["lon"].to_numpy(dtype="float64")
+        located = np.flatnonzero(~(np.isnan(lat) | np.isnan(lon)))
+        cell_x = np.floor(lon[located] / cell_size).astype(np.int64)
+        cell_y = np.floor(lat[located] / cell_size).astype(np.int64)
+        # Samples grouped by cell, with the start and end of every occupied cell.
+        order = np.lexsort((cell_y, cell_x))
+        self.positions = located[order]
+        self.lat = lat[self.positions]
+        self.lon = lon[self.positions]
+        cell_x, cell_y = cell_x[order], cell_y[order]
+        starts = np.flatnonzero(np.diff(cell_x, prepend=np.int64(-2 ** 62))
+                                | np.diff(cell_y, prepend=np.int64(-2 ** 62)))
+        self.cell_x = cell_x[starts]
+        self.cell_y = cell_y[starts]
+        self.cell_start = starts
+        self.cell_end = np.append(starts[1:], len(order)).astype(np.int64)
+
+    def _candidates(self, west, south, east, north):
+        # Offsets into `positions` of the samples in cells overlapping the box.
+        cells = np.flatnonzero(
+            (self.cell_x >= np.floor(west / self.cell_size))
+            & (self.cell_x <= np.floor(east / self.cell_size))
+            & (self.cell_y >= np.floor(south / self.cell_size))
+            & (self.cell_y <= np.floor(north / self.cell_size)))
+        lengths = self.cell_end[cells] - self.cell_start[cells]
+        offsets = np.repeat(self.cell_start[cells] - np.cumsum(lengths) + lengths,
+                            lengths)
+        return offsets + np.arange(lengths.sum())
+
+    def _result(self, candidates, mask):
+        return np.sort(self.positions[candidates[mask]])
+
+    def box(self, west, south, east, north) -> np.ndarray:
+        candidates = self._candidates(west, south, east, north)
+        lat, lon = self.lat[candidates], self.lon[candidates]
+        return self._result(candidates, (lon >= west) & (lon <= east)
+                            & (lat >= south) & (lat <= north))
+
+    def polygon(self, points) -> np.ndarray:
+        # `points` are (lon, lat) vertices, tested with ray casting.
+        ring = np.asarray(points, dtype="float64")
+        candidates = self._candidates(ring[:, 0].min(), ring[:, 1].min(),
+                                      ring[:, 0].max(), ring[:, 1].max())
+        lat, lon = self.lat[candidates], self.lon[candidates]
+        inside = np.zeros(len(candidates), dtype=bool)
+        for (x1, y1), (x2, y2) in zip(ring, np.roll(ring, -1, axis=0)):
+            if y1 == y2:
+                continue
+            crosses = ((y1 > lat) != (y2 > lat)) & (
+                lon < (x2 - x1) * (lat - y1) / (y2 - y1) + x1)
+            inside ^= crosses
+        return self._result(candidates, inside)
+
+    def cell(self, lat, lon, size) -> np.ndarray:
+        # Samples sharing the grid cell of `size` degrees containing a point.
+        x, y = np.floor(lon / size), np.floor(lat / size)
+        candidates = self._candidates(x * size, y * size,
+                                      (x + 1) * size, (y + 1) * size)
+        return self._result(
+            candidates, (np.floor(self.lon[candidates] / size) == x)
+            & (np.floor(self.lat[candidates] / size) == y))
+
+    def site(self, lat, lon) -> np.ndarray:
+        candidates = self._candidates(lon, lat, lon, lat)
+        return self._result(candidates, (self.lat[candidates] == lat)
+                            & (self.lon[candidates] == lon))
+
+    def lookup(self, ids) -> np.ndarray:
+        positions = self.ids.get_indexer(ids)
+        return np.sort(positions[positions >= 0])
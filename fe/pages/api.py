@@ -2,6 +2,8 @@ import dash
 import dash_bootstrap_components as dbc
 from dash import html
 
+from api_client import API_PUBLIC_URL
+
 dash.register_page(
     __name__,
     title="API",
@@ -10,7 +12,7 @@ dash.register_page(
 
 def iframe_layout():
     return html.Iframe(
-        src="https://trec-be-868757013548.europe-west2.run.app/redoc",
+        src=f"{API_PUBLIC_URL}/redoc",
         style={
             "display": "block",
             "height": "100vh",
@@ -1,10 +1,12 @@
+import os
 from typing import Any
 
 import dash
-import requests
 
 import dash_bootstrap_components as dbc
-from dash import callback, Output, Input, html
+from dash import callback, ctx, dcc, Output, Input, State, html
+
+from api_client import api
 
 dash.register_page(
     __name__,
@@ -12,56 +14,36 @@ dash.register_page(
     title="Data",
 )
 
+# Filterable fields and the titles of their cards.
+FILTERS = {"organism": "Organism", "depth": "Depth", "altitude": "Altitude",
+           "location": "Geographic Location"}
+
+
+def filter_card(field: str, title: str) -> dbc.Card:
+    # Only the top buckets are shown at first, more are loaded on demand.
+    return dbc.Card(
+        dbc.CardBody(
+            [
+                html.H4(title, className="card-title"),
+                html.Hr(),
+                dbc.Input(id=f"{field}_search", placeholder="Search...",
+                          type="text", size="sm", debounce=True,
+                          className="mb-2"),
+                dbc.Checklist(id=f"{field}_filter"),
+                dbc.Button("Show more", id=f"{field}_more", color="link",
+                           size="sm", disabled=True, className="p-0"),
+                dcc.Store(id=f"{field}_after"),
+            ]
+        ),
+        style={"margin-bottom": "5px", "maxHeight": "15em", "overflowY": "auto"},
+    )
+
+
 layout = dbc.Container(
     dbc.Row(
         [
             dbc.Col(
-                [
-                    dbc.Card(
-                        dbc.CardBody(
-                            [
-                                html.H4("Organism", className="card-title"),
-                                html.Hr(),
-                                dbc.Checklist(id="organism_filter")
-                            ]
-                        ),
-                        style={"margin-bottom": "5px", "maxHeight": "15em",
-                               "overflowY": "auto"},
-                    ),
-                    dbc.Card(
-                        dbc.CardBody(
-                            [
-                                html.H4("Depth", className="card-title"),
-                                html.Hr(),
-                                dbc.Checklist(id="depth_filter")
-                            ]
-                        ),
-                        style={"margin-bottom": "5px", "maxHeight": "15em",
-                               "overflowY": "auto"},
-                    ),
-                    dbc.Card(
-                        dbc.CardBody(
-                            [
-                                html.H4("Altitude", className="card-title"),
-                                html.Hr(),
-                                dbc.Checklist(id="altitude_filter")
-                            ]
-                        ),
-                        style={"margin-bottom": "5px", "maxHeight": "15em",
-                               "overflowY": "auto"},
-                    ),
-                    dbc.Card(
-                        dbc.CardBody(
-                            [
-                                html.H4("Geographic Location", className="card-title"),
-                                html.Hr(),
-                                dbc.Checklist(id="location_filter")
-                            ]
-                        ),
-                        style={"margin-bottom": "5px", "maxHeight": "15em",
-                               "overflowY": "auto"},
-                    )
-                ],
+                [filter_card(field, title) for field, title in FILTERS.items()],
                 id="filters-card",
                 md=3,
                 style={"marginBottom": "5px"},
@@ -91,16 +73,19 @@ layout = dbc.Container(
 )
 
 
-def generate_filters(aggregations: list) -> tuple[list, int]:
-    options = []
-    total_count = 0
-    for bucket in aggregations:
-        total_count += bucket["doc_count"]
-        options.append(
-            {"label": f"{bucket['key']} - {bucket['doc_count']}",
-             "value": bucket['key']}
-        )
-    return options, total_count
+PAGE_SIZE = 20
+# Elasticsearch rejects start + size beyond the index max_result_window, so
+# pages past it cannot be shown.
+MAX_RESULT_WINDOW = int(os.getenv("TREC_MAX_RESULT_WINDOW", 10000))
+MAX_PAGES = MAX_RESULT_WINDOW // PAGE_SIZE
+
+
+def generate_filters(aggregations: list) -> list:
+    return [
+        {"label": f"{bucket['key']} - {bucket['doc_count']}",
+         "value": bucket["key"]}
+        for bucket in aggregations
+    ]
 
 
 def return_sample_id_button(biosample_id: str) -> html.A:
@@ -111,13 +96,101 @@ def return_sample_id_button(biosample_id: str) -> html.A:
     )
 
 
+def search_params(filters: list, input_value) -> dict:
+    params = {}
+    for field_name, values in zip(FILTERS, filters):
+        if values is not None and len(values) > 0:
+            params[field_name] = values[0]
+    if input_value is not None:
+        params["q"] = input_value
+    return params
+
+
+def facet_params(params: dict, field: str) -> dict:
+    # Searching and paging a facet lists the alternatives to its own filter.
+    return {name: value for name, value in params.items() if name != field}
+
+
 @callback(
-    Output("data_table", "children"),
-    Output("organism_filter", "options"),
-    Output("depth_filter", "options"),
-    Output("altitude_filter", "options"),
-    Output("location_filter", "options"),
+    *[Output(f"{field}_filter", "options") for field in FILTERS],
+    *[Output(f"{field}_after", "data") for field in FILTERS],
+    *[Output(f"{field}_more", "disabled") for field in FILTERS],
     Output("pagination", "max_value"),
+    *[Input(f"{field}_filter", "value") for field in FILTERS],
+    Input("input", "value"),
+    *[State(f"{field}_search", "value") for field in FILTERS],
+)
+def update_facets(*args):
+    # Facet counts and the number of pages only change with the filters.
+    filters, input_value = args[:len(FILTERS)], args[len(FILTERS)]
+    searches = args[len(FILTERS) + 1:]
+    params = search_params(filters, input_value)
+    # Pages are counted exactly by the count endpoint.
+    response = api.get("data_portal/aggregations",
+                       params={**params, "track_total_hits": "off"})
+    count = api.get("data_portal/count", params=params)["count"]
+    options, after, done = [], [], []
+    for field, search in zip(FILTERS, searches):
+        aggregation = response["aggregations"][field]
+        if search:
+            # Keep showing the buckets matching the search of the card.
+            facet = api.get(f"data_portal/facets/{field}",
+                            params={**facet_params(params, field),
+                                    "prefix": search})
+            options.append(generate_filters(facet["buckets"]))
+            after.append(facet["after"])
+            done.append(facet["after"] is None)
+        else:
+            options.append(generate_filters(aggregation["buckets"]))
+            after.append(None)
+            done.append(aggregation["sum_other_doc_count"] == 0)
+    return (*options, *after, *done,
+            max(1, min(-(-count // PAGE_SIZE), MAX_PAGES)))
+
+
+def register_facet_search(field: str):
+    @callback(
+        Output(f"{field}_filter", "options", allow_duplicate=True),
+        Output(f"{field}_after", "data", allow_duplicate=True),
+        Output(f"{field}_more", "disabled", allow_duplicate=True),
+        Input(f"{field}_search", "value"),
+        Input(f"{field}_more", "n_clicks"),
+        State(f"{field}_filter", "options"),
+        State(f"{field}_after", "data"),
+        *[State(f"{name}_filter", "value") for name in FILTERS],
+        State("input", "value"),
+        prevent_initial_call=True,
+    )
+    def update_facet(search, n_clicks, options, after, *args):
+        # Buckets beyond the top ones are paged in key order.
+        filters, input_value = args[:-1], args[-1]
+        params = facet_params(search_params(filters, input_value), field)
+        if search:
+            params["prefix"] = search
+        options = options or []
+        if ctx.triggered_id == f"{field}_more":
+            if after is not None:
+                params["after"] = after
+        else:
+            # A new search starts over, keeping the checked values.
+            checked = set(filters[list(FILTERS).index(field)] or [])
+            options = [option for option in options if option["value"] in checked]
+        response = api.get(f"data_portal/facets/{field}", params=params)
+        shown = {option["value"] for option in options}
+        options = options + [option for option in generate_filters(response["buckets"])
+                             if option["value"] not in shown]
+        return options, response["after"], response["after"] is None
+
+    return update_facet
+
+
+for filter_field in FILTERS:
+    register_facet_search(filter_field)
+
+
+@callback(
+    Output("data_table", "children"),
+    Output("pagination", "active_page"),
     Input("organism_filter", "value"),
     Input("depth_filter", "value"),
     Input("altitude_filter", "value"),
@@ -125,31 +198,21 @@ def return_sample_id_button(biosample_id: str) -> html.A:
     Input("input", "value"),
     Input("pagination", "active_page"),
     running=[
-        (Output("input", "class_name"), "invisible",
-         "visible"),
         (Output("pagination", "class_name"), "invisible",
          "justify-content-end"),
-        (Output("filters-card", "class_name"), "invisible",
-         "card-title")
     ]
 )
-def create_update_data_table(organism_filter, depth_filter, altitude_filter,
-                             location_filter, input_value, pagination):
-    if pagination is None or pagination == 1:
-        start = 0
-    else:
-        start = (pagination - 1) * 20
-    params = {"size": 20, "start": start}
-    for field_name, values in {"organism": organism_filter, "depth": depth_filter,
-                               "altitude": altitude_filter,
-                               "location": location_filter}.items():
-        if values is not None and len(values) > 0:
-            params[field_name] = values[0]
-    if input_value is not None:
-        params["q"] = input_value
-    response = requests.get(
-        "https://trec-be-868757013548.europe-west2.run.app/data_portal",
-        params=params).json()
+def update_hits(organism_filter, depth_filter, altitude_filter, location_filter,
+                input_value, pagination):
+    # New filters start from the first page.
+    if ctx.triggered_id != "pagination" or pagination is None:
+        pagination = 1
+    params = {"size": PAGE_SIZE, "start": (pagination - 1) * PAGE_SIZE,
+              "aggregations": "false", "fields": "summary",
+              "track_total_hits": "off",
+              **search_params([organism_filter, depth_filter, altitude_filter,
+                               location_filter], input_value)}
+    response = api.get("data_portal", params=params)
 
     table_header = [
         html.Thead(html.Tr([html.Th(value, className="text-center") for value in
@@ -169,14 +232,4 @@ def create_update_data_table(organism_filter, depth_filter, altitude_filter,
     ]
     table = dbc.Table(table_header + table_body, striped=True, bordered=True,
                       hover=True, responsive=True, )
-
-    organism_options, total_count = generate_filters(
-        response["aggregations"]["organism"]["buckets"])
-    depth_options, _ = generate_filters(response["aggregations"]["depth"]["buckets"])
-    altitude_options, _ = generate_filters(
-        response["aggregations"]["altitude"]["buckets"])
-    location_options, _ = generate_filters(
-        response["aggregations"]["location"]["buckets"])
-
-    return (table, organism_options, depth_options, altitude_options, location_options,
-            total_count // 20 + 1)
+    return table, pagination
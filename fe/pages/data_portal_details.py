@@ -1,11 +1,26 @@
-import requests
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from urllib.parse import urlencode
+
 import dash
-import plotly.express as px
-import pandas as pd
 import dash_bootstrap_components as dbc
-from dash import callback, html, Output, Input, dcc
+import requests
+from dash import callback, html, Output, Input
+
+from api_client import api
 from .data_portal import return_sample_id_button
 
+logger = logging.getLogger(__name__)
+
+# Rendered detail pages kept per worker, keyed by sample ID.
+DETAILS_CACHE_TTL = float(os.getenv("DETAILS_CACHE_TTL_SECONDS", 300))
+DETAILS_CACHE_SIZE = int(os.getenv("DETAILS_CACHE_SIZE", 256))
+# Half the width and height in degrees of the area shown around a sample.
+DETAILS_MAP_SPAN = 0.05
+
 dash.register_page(
     __name__,
     path_template="/data-portal/<sample_id>",
@@ -29,14 +44,86 @@ def layout(sample_id=None, **kwargs):
     )
 
 
-@callback(
-    Output("card", "children"),
-    Input("card", "key"),
-)
-def build_data_portal_details_page(sample_id):
-    response = requests.get(
-        f"https://trec-be-868757013548.europe-west2.run.app/data_portal/{sample_id}"
-    ).json()
+_details_cache = OrderedDict()
+_details_lock = threading.Lock()
+
+
+def cached_details(sample_id):
+    with _details_lock:
+        entry = _details_cache.get(sample_id)
+        if entry is not None and entry[0] > time.monotonic():
+            _details_cache.move_to_end(sample_id)
+            return entry[1]
+    return None
+
+
+def cache_details(sample_id, children):
+    if DETAILS_CACHE_TTL <= 0:
+        return
+    with _details_lock:
+        _details_cache[sample_id] = (time.monotonic() + DETAILS_CACHE_TTL, children)
+        _details_cache.move_to_end(sample_id)
+        while len(_details_cache) > DETAILS_CACHE_SIZE:
+            _details_cache.popitem(last=False)
+
+
+def related_summaries(sample_id, relationships):
+    # Summaries of all related samples in one batch request, missing samples
+    # are left out. None if they could not be fetched.
+    ids = list(dict.fromkeys(
+        record_id for row in relationships for record_id in
+        (row["source"], row["target"]) if record_id != sample_id))
+    if not ids:
+        return {}
+    summaries = {}
+    try:
+        for start in range(0, len(ids), 1000):
+            response = api.post("data_portal/batch",
+                                json={"ids": ids[start:start + 1000]},
+                                params={"fields": "summary"})
+            summaries.update((row["biosampleId"], row)
+                             for row in response["results"])
+    except requests.RequestException:
+        logger.exception("Resolving the samples related to %s failed", sample_id)
+        return None
+    return summaries
+
+
+def location_map(lat, lon):
+    # OpenStreetMap embed with a marker, instead of a Plotly map per record.
+    bbox = ",".join(str(value) for value in (
+        lon - DETAILS_MAP_SPAN, lat - DETAILS_MAP_SPAN,
+        lon + DETAILS_MAP_SPAN, lat + DETAILS_MAP_SPAN))
+    query = urlencode({"bbox": bbox, "layer": "mapnik", "marker": f"{lat},{lon}"})
+    return html.Div([
+        html.Iframe(src=f"https://www.openstreetmap.org/export/embed.html?{query}",
+                    style={"width": "100%", "height": "350px", "border": "0"}),
+        html.A("View larger map", style={"textDecoration": "none"},
+               href=f"https://www.openstreetmap.org/?mlat={lat}&mlon={lon}"
+                    f"#map=13/{lat}/{lon}", target="_blank"),
+    ], style={"marginBottom": "15px"})
+
+
+def related_sample(record_id, sample_id, summaries):
+    if record_id == sample_id:
+        return html.Span(record_id)
+    if summaries is None:
+        return return_sample_id_button(record_id)
+    summary = summaries.get(record_id)
+    if summary is None:
+        return html.Span(record_id, className="text-muted",
+                         title="Not available in the data portal")
+    return html.Div([
+        return_sample_id_button(record_id),
+        html.Div(f"{summary['organism']}, {summary['location']}",
+                 className="small text-muted"),
+    ])
+
+
+def render_details(sample_id):
+    """Render the detail card of a sample, and whether it is complete enough
+    to be cached."""
+    response = api.get(f"data_portal/{sample_id}")
     response = response["results"][0]
     children = [
         html.H3(response["biosampleId"], className="card-title", id="header"),
@@ -59,12 +146,13 @@ def build_data_portal_details_page(sample_id):
         ]
     )
     children.append(desc_list)
-    if "lat" in response and "lon" in response:
-        df = pd.DataFrame([{"lat": response["lat"], "lon": response["lon"]}])
-        fig = px.scatter_map(df, lat="lat", lon="lon", zoom=11)
+    if response.get("lat") is not None and response.get("lon") is not None:
         children.append(html.H4("Sampling Map"))
-        children.append(dcc.Graph(figure=fig))
-    if "relationships" in response and len(response["relationships"]) > 0:
+        children.append(location_map(response["lat"], response["lon"]))
+    summaries = {}
+    if response.get("relationships"):
+        summaries = related_summaries(response["biosampleId"],
+                                      response["relationships"])
         children.append(html.H4("Relationships"))
         table_header = [
             html.Thead(html.Tr([html.Th(value, className="text-center") for value in
@@ -72,10 +160,12 @@ def build_data_portal_details_page(sample_id):
         table_body = [
             html.Tbody(
                 [html.Tr(
-                    [html.Td(return_sample_id_button(row["source"]),
+                    [html.Td(related_sample(row["source"],
+                                            response["biosampleId"], summaries),
                              className="text-center"),
                      html.Td(row["type"], className="text-center"),
-                     html.Td(return_sample_id_button(row["target"]),
+                     html.Td(related_sample(row["target"],
+                                            response["biosampleId"], summaries),
                              className="text-center")])
                     for
                     row in response["relationships"]])
@@ -83,4 +173,17 @@ def build_data_portal_details_page(sample_id):
         table = dbc.Table(table_header + table_body, striped=True, bordered=True,
                           hover=True, responsive=True)
         children.append(table)
+    return children, summaries is not None
+
+
+@callback(
+    Output("card", "children"),
+    Input("card", "key"),
+)
+def build_data_portal_details_page(sample_id):
+    children = cached_details(sample_id)
+    if children is None:
+        children, complete = render_details(sample_id)
+        if complete:
+            cache_details(sample_id, children)
     return children
@@ -1,9 +1,12 @@
 import dash
-import os
-from dash import dcc, callback, Output, Input, dash_table
+from dash import (dcc, callback, clientside_callback, ctx, Output, Input, State,
+                  dash_table)
+from dash.exceptions import PreventUpdate
 import dash_bootstrap_components as dbc
-import plotly.express as px
-import pandas as pd
+import numpy as np
+import plotly.graph_objects as go
+
+from map_data import MAP_DATA_DIR, MAP_DATA_POLL_SECONDS, MapDataStore
 
 dash.register_page(
     __name__,
@@ -11,13 +14,86 @@ dash.register_page(
     title="Sampling Map",
 )
 
-DATA = pd.read_parquet(os.path.abspath("./") + "/pages" + "/sampling_map.parquet")
+# Below MAP_FULL_DETAIL_ZOOM points are merged per grid cell, with about
+# MAP_CELLS_PER_TILE cells across every 256px map tile.
+MAP_CELLS_PER_TILE = 32
+MAP_FULL_DETAIL_ZOOM = 12
+MAP_INITIAL_ZOOM = 3
+
+
+def map_level(zoom):
+    return min(int(zoom), MAP_FULL_DETAIL_ZOOM)
+
+
+def map_cell_size(level):
+    return 360 / (2 ** level * MAP_CELLS_PER_TILE)
+
+
+def map_points(snapshot, level):
+    return snapshot.cached(("points", level),
+                           lambda: build_map_points(snapshot.data, level))
+
+
+def build_map_points(data, level):
+    # One marker per grid cell, or per sampling site at full detail, placed at
+    # the mean position of its samples.
+    data = data[["lat", "lon", "id"]].dropna(subset=["lat", "lon"])
+    if level >= MAP_FULL_DETAIL_ZOOM:
+        keys = [data["lat"], data["lon"]]
+    else:
+        cell = map_cell_size(level)
+        keys = [np.floor(data["lat"] / cell), np.floor(data["lon"] / cell)]
+    return data.groupby(keys).agg(
+        lat=("lat", "mean"), lon=("lon", "mean"), id=("id", "first"),
+        count=("id", "size")).reset_index(drop=True)
+
+
+def map_figure(snapshot, level):
+    return snapshot.cached(("figure", level),
+                           lambda: build_map_figure(map_points(snapshot, level)))
+
+
+def build_map_figure(points):
+    counts = points["count"].to_numpy()
+    # WebGL trace with typed arrays for the numeric columns.
+    figure = go.Figure(go.Scattermap(
+        lat=points["lat"].to_numpy("float32"),
+        lon=points["lon"].to_numpy("float32"),
+        hovertext=points["id"].to_numpy(),
+        customdata=counts.astype("int32"),
+        hovertemplate="%{hovertext}<br>%{customdata} samples<extra></extra>",
+        marker={"size": np.clip(6 + 2 * np.log2(counts), 6, 24).astype("float32")},
+        mode="markers",
+    ))
+    figure.update_layout(
+        map={"zoom": MAP_INITIAL_ZOOM,
+             "center": {"lat": float(points["lat"].mean()),
+                        "lon": float(points["lon"].mean())}},
+        height=800,
+        margin={"l": 0, "r": 0, "t": 0, "b": 0},
+        # Keep the user's zoom and pan when the points are replaced.
+        uirevision="sampling-map",
+    )
+    return figure
+
+
+# Map data of this worker, new snapshots are swapped in with their initial
+# figure already built.
+MAP_DATA = MapDataStore(
+    MAP_DATA_DIR, MAP_DATA_POLL_SECONDS,
+    warm=lambda snapshot: map_figure(snapshot, map_level(MAP_INITIAL_ZOOM)))
+MAP_DATA.start()
 
 
 def layout(**kwargs):
     return dbc.Container([
         dbc.Row(
-            dbc.Col(dbc.Spinner(dcc.Graph(id="sampling-map")), md=12, id="col-map")),
+            # The figure is sent by build_map once the page loads, keeping it
+            # out of the layout and of the validation layout of every page.
+            dbc.Col(dbc.Spinner(dcc.Graph(id="sampling-map")),
+                    md=12, id="col-map")),
+        dcc.Store(id="sampling-map-level", data=map_level(MAP_INITIAL_ZOOM)),
+        dcc.Store(id="sampling-map-selection"),
         dbc.Row(
             dbc.Col(dash_table.DataTable(
                 id="datatable-paging",
@@ -42,37 +118,98 @@ def layout(**kwargs):
 
 @callback(
     Output("sampling-map", "figure"),
-    Input("sampling-map", "figure"),
+    Output("sampling-map-level", "data"),
+    Input("sampling-map", "relayoutData"),
+    State("sampling-map-level", "data"),
 )
-def build_map(sampling_map):
-    map_fig = px.scatter_map(DATA, lat="lat", lon="lon", zoom=3, hover_name="id",
-                             height=800)
-    return map_fig
+def build_map(relayout_data, current_level):
+    if ctx.triggered_id is None:
+        # Initial load, at the level the store starts at.
+        return map_figure(MAP_DATA.current, current_level), current_level
+    # Only zooming across a level changes the points, panning reuses them.
+    zoom = (relayout_data or {}).get("map.zoom")
+    if zoom is None or map_level(zoom) == current_level:
+        raise PreventUpdate
+    level = map_level(zoom)
+    return map_figure(MAP_DATA.current, level), level
+
+
+# Only the selected area is sent to the server, not every selected point.
+clientside_callback(
+    """
+    function(selectedData) {
+        if (!selectedData || !(selectedData.range || selectedData.lassoPoints)) {
+            return null;
+        }
+        return {range: selectedData.range, lassoPoints: selectedData.lassoPoints};
+    }
+    """,
+    Output("sampling-map-selection", "data"),
+    Input("sampling-map", "selectedData"),
+)
+
+
+TABLE_COLUMNS = ["id", "organism", "depth", "altitude", "location"]
+
+
+def table_records(rows):
+    # Records of the current page only, with their links.
+    records = [dict(zip(TABLE_COLUMNS, values)) for values in
+               zip(*(rows[name].tolist() for name in TABLE_COLUMNS))]
+    for record in records:
+        record["links"] = f"[{record['id']}](/data-portal/{record['id']})"
+    return records
+
+
+def selected_positions(snapshot, selection, click_data, level):
+    # Row positions in the selected area and in the clicked marker.
+    data, index = snapshot.data, snapshot.index
+    positions = []
+    if selection is not None:
+        if selection.get("range"):
+            (lon_1, lat_1), (lon_2, lat_2) = next(iter(selection["range"].values()))
+            positions.append(index.box(min(lon_1, lon_2), min(lat_1, lat_2),
+                                       max(lon_1, lon_2), max(lat_1, lat_2)))
+        if selection.get("lassoPoints"):
+            positions.append(index.polygon(
+                next(iter(selection["lassoPoints"].values()))))
+    if click_data is not None:
+        # Markers are labelled with one of their samples, whose coordinates
+        # identify the merged cell or site.
+        for point in click_data["points"]:
+            sample = index.lookup([point["hovertext"]])
+            if not len(sample):
+                continue
+            lat, lon = data["lat"].iat[sample[0]], data["lon"].iat[sample[0]]
+            if level >= MAP_FULL_DETAIL_ZOOM:
+                positions.append(index.site(lat, lon))
+            else:
+                positions.append(index.cell(lat, lon, map_cell_size(level)))
+    return np.unique(np.concatenate(positions)) if positions else np.empty(0, int)
 
 
 @callback(
     Output("datatable-paging", "data"),
     Output("datatable-paging", "page_count"),
     Output("datatable-paging", "page_current"),
-    Input("sampling-map", "selectedData"),
+    Input("sampling-map-selection", "data"),
     Input("sampling-map", "clickData"),
     Input('datatable-paging', "page_current"),
-    Input('datatable-paging', "page_size")
+    Input('datatable-paging', "page_size"),
+    State("sampling-map-level", "data"),
 )
-def build_table(selected_data, click_data, page_current, page_size):
-    if selected_data is None and click_data is None:
-        return DATA.iloc[
+def build_table(selection, click_data, page_current, page_size, level):
+    snapshot = MAP_DATA.current
+    data = snapshot.data
+    if selection is None and click_data is None:
+        return table_records(data.iloc[
                page_current * page_size:(page_current + 1) * page_size
-               ].to_dict("records"), len(DATA.index) // page_size + 1, page_current
+               ]), len(data.index) // page_size + 1, page_current
     else:
-        selected_samples = []
-        if selected_data is not None:
-            selected_samples.extend(
-                [item["hovertext"] for item in selected_data["points"]])
-        if click_data is not None:
-            selected_samples.extend(
-                [item["hovertext"] for item in click_data["points"]])
-        filtered_df = DATA[DATA["id"].isin(selected_samples)]
-        return filtered_df.iloc[
-               page_current * page_size:(page_current + 1) * page_size
-               ].to_dict("records"), len(filtered_df.index) // page_size + 1, 0
+        # Start from the first page whenever the selection changes.
+        if ctx.triggered_id != "datatable-paging":
+            page_current = 0
+        positions = selected_positions(snapshot, selection, click_data, level)
+        return table_records(data.iloc[
+               positions[page_current * page_size:(page_current + 1) * page_size]
+               ]), len(positions) // page_size + 1, page_current
@@ -0,0 +1,143 @@
+"""Refresh the sampling map data from the backend.
+
+Only records updated since the last snapshot are exported and merged into a
+new versioned Arrow file. The manifest is then replaced atomically, and
+running workers switch to the new snapshot within MAP_DATA_POLL_SECONDS.
+Deleted records are only dropped by a --full refresh.
+
+    python refresh_map_data.py [--full] [--keep 3]
+"""
+import argparse
+import datetime
+import glob
+import json
+import os
+import tempfile
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.feather
+
+from api_client import api
+from map_data import (DICTIONARY_COLUMNS, MANIFEST_NAME, MAP_COLUMNS,
+                      MAP_DATA_DIR, read_manifest, read_map_data)
+
+EXPORT_FIELDS = ["biosampleId", "organism", "depth", "altitude", "location",
+                 "lat", "lon"]
+# Records updated shortly before the last sync are fetched again, in case they
+# were not yet searchable or the clocks disagree.
+SYNC_OVERLAP = datetime.timedelta(minutes=10)
+
+
+def fetch_changes(since):
+    params = {"format": "ndjson", "fields": ",".join(EXPORT_FIELDS)}
+    if since is not None:
+        params["updated_since"] = since.isoformat()
+    with api.stream("data_portal/export", params=params,
+                    read_timeout=300) as response:
+        records = [json.loads(line) for line in response.iter_lines() if line]
+    return to_map_frame(pd.DataFrame.from_records(records, columns=EXPORT_FIELDS))
+
+
+def to_map_frame(records):
+    return pd.DataFrame({
+        "lat": records["lat"].astype("float64"),
+        "lon": records["lon"].astype("float64"),
+        "id": records["biosampleId"].astype(str),
+        "organism": records["organism"],
+        "depth": records["depth"],
+        "altitude": records["altitude"],
+        "location": records["location"],
+    })
+
+
+def read_snapshot(path):
+    # Dictionary columns are read as categories, decoded for merging.
+    data = read_map_data(path)
+    return data.astype({name: str for name in DICTIONARY_COLUMNS})
+
+
+def write_map_data(data, path):
+    # Uncompressed, so that workers can memory map the file without copies.
+    table = pa.Table.from_pandas(data[MAP_COLUMNS], preserve_index=False)
+    table = pa.table({
+        name: table[name].dictionary_encode() if name in DICTIONARY_COLUMNS
+        else table[name] for name in MAP_COLUMNS})
+    pyarrow.feather.write_feather(table, path, compression="uncompressed")
+
+
+def merge(current, changes):
+    # Changed records are updated in place, new records are appended.
+    data = current.set_index("id")
+    changes = changes.drop_duplicates("id", keep="last").set_index("id")
+    existing = changes.index.isin(data.index)
+    data.loc[changes.index[existing], changes.columns] = changes[existing]
+    data = pd.concat([data, changes[~existing]])
+    return data.reset_index()[current.columns]
+
+
+def write_atomic(path, write):
+    # Readers see either the previous file or the complete new one.
+    fd, temporary = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp-")
+    os.close(fd)
+    try:
+        write(temporary)
+        with open(temporary, "rb") as f:
+            os.fsync(f.fileno())
+        os.replace(temporary, path)
+    except BaseException:
+        os.unlink(temporary)
+        raise
+
+
+def write_snapshot(directory, data, synced_at):
+    version = synced_at.strftime("%Y%m%dT%H%M%S%fZ")
+    file_name = f"sampling_map-{version}.arrow"
+    write_atomic(os.path.join(directory, file_name),
+                 lambda path: write_map_data(data, path))
+
+    def write_manifest(path):
+        with open(path, "w") as f:
+            json.dump({"version": version, "file": file_name,
+                       "synced_at": synced_at.isoformat(), "rows": len(data)}, f)
+
+    write_atomic(os.path.join(directory, MANIFEST_NAME), write_manifest)
+    return version
+
+
+def remove_old_snapshots(directory, keep):
+    # Workers may still be loading the previous snapshots, keep a few.
+    snapshots = sorted(glob.glob(os.path.join(directory, "sampling_map-*.arrow")))
+    for path in snapshots[:-keep]:
+        os.unlink(path)
+
+
+def refresh(directory, full=False, keep=3):
+    synced_at = datetime.datetime.now(datetime.timezone.utc)
+    manifest = read_manifest(directory)
+    # The bundled snapshot has no sync time, so the first refresh is full.
+    if full or manifest is None:
+        changes = data = fetch_changes(None)
+    else:
+        since = datetime.datetime.fromisoformat(manifest["synced_at"]) - SYNC_OVERLAP
+        changes = fetch_changes(since)
+        current = read_snapshot(os.path.join(directory, manifest["file"]))
+        data = merge(current, changes)
+    version = write_snapshot(directory, data, synced_at)
+    remove_old_snapshots(directory, keep)
+    print(f"{len(changes)} changed records, {len(data)} records in {version}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--full", action="store_true",
+                        help="fetch every record instead of the changes")
+    parser.add_argument("--keep", type=int, default=3,
+                        help="number of snapshots to keep")
+    parser.add_argument("--directory", default=MAP_DATA_DIR)
+    args = parser.parse_args()
+    refresh(args.directory, full=args.full, keep=max(1, args.keep))
+
+
+if __name__ == "__main__":
+    main()